@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+import sys
+import json
+import os
+import re
+import sqlite3
+from deriva.core import ErmrestCatalog, HatracStore, get_credential, urlquote
+from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX
+from atlas_d2k.utils.data import get_entities
+from atlas_d2k.utils.model import get_asset_columns, get_catalog_model
+from atlas_d2k.utils.hatrac import walk_hatrac_namespaces, base64_to_hex
+
+''' Hatrac inventory
+ - Walk hatrac namespaces and record objects (path, version, bytes, md5) in a local sqlite file
+ - Record the hatrac urls referenced by every asset column of the catalog
+ - Report orphans (objects not referenced by any row), missing objects (referenced but not
+   in hatrac), and bytes per namespace
+
+ Later runs are incremental: the metadata of objects already in the inventory are not fetched
+ again unless --full is specified. Objects that disappeared from hatrac are removed.
+'''
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS hatrac_object (
+  path text PRIMARY KEY,
+  namespace text NOT NULL,
+  version_url text,
+  bytes integer,
+  md5 text,
+  run integer NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hatrac_object_namespace_idx ON hatrac_object (namespace);
+CREATE TABLE IF NOT EXISTS catalog_ref (
+  sname text NOT NULL,
+  tname text NOT NULL,
+  cname text NOT NULL,
+  rid text NOT NULL,
+  url text NOT NULL,
+  path text NOT NULL,
+  md5 text,
+  bytes integer,
+  PRIMARY KEY (sname, tname, cname, rid)
+);
+CREATE INDEX IF NOT EXISTS catalog_ref_path_idx ON catalog_ref (path);
+CREATE TABLE IF NOT EXISTS inventory_run (
+  run integer PRIMARY KEY AUTOINCREMENT,
+  host text,
+  catalog_id text,
+  namespaces text,
+  started timestamp DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# -- -----------------------------------------------------------------
+def open_inventory(db_file):
+    os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+    db = sqlite3.connect(db_file)
+    db.executescript(SCHEMA_SQL)
+    return db
+
+# -- -----------------------------------------------------------------
+# /hatrac/a/b/c -> /hatrac/a/b when depth=3
+def namespace_prefix(path, depth):
+    parts = path.strip("/").split("/")
+    return "/" + "/".join(parts[0:min(depth, len(parts)-1)])
+
+# -- -----------------------------------------------------------------
+# object path without the version e.g. /hatrac/a/b.txt:VERSION -> /hatrac/a/b.txt
+def unversioned_path(url):
+    return re.match("^([^:]+)", url)[1]
+
+# -- -----------------------------------------------------------------
+# sql condition and parameters matching the paths under a namespace. Paths are compared by
+# prefix instead of LIKE, since _ and % are wildcards in LIKE and _ is common in hatrac paths.
+def under_namespace(column, ns):
+    prefix = ns.rstrip("/") + "/"
+    return "substr(%s, 1, ?) = ?" % (column), [len(prefix), prefix]
+
+# -- -----------------------------------------------------------------
+def update_hatrac_objects(db, store, namespaces, run, workers, full, depth):
+    known_objects = set()
+    if not full:
+        for (path,) in db.execute("SELECT path FROM hatrac_object"):
+            known_objects.add(path)
+
+    walked_namespaces, objects = walk_hatrac_namespaces(store, namespaces, workers=workers, known_objects=known_objects)
+
+    new_rows = []
+    for path, md in objects.items():
+        if md is None: continue
+        md5 = base64_to_hex(md["content-md5"]) if "content-md5" in md.keys() else None
+        nbytes = int(md["content-length"]) if "content-length" in md.keys() else None
+        new_rows.append((path, namespace_prefix(path, depth), md.get("content-location"), nbytes, md5, run))
+    db.executemany("INSERT OR REPLACE INTO hatrac_object (path, namespace, version_url, bytes, md5, run) VALUES (?,?,?,?,?,?)", new_rows)
+    db.executemany("UPDATE hatrac_object SET run=? WHERE path=?", [ (run, p) for p, md in objects.items() if md is None ])
+    # -- objects under the walked namespaces that were not seen in this run no longer exist
+    for ns in namespaces:
+        condition, params = under_namespace("path", ns)
+        db.execute("DELETE FROM hatrac_object WHERE run<>? AND (path=? OR %s)" % (condition), [run, ns.rstrip("/")] + params)
+    db.commit()
+    print("update_hatrac_objects: %d objects (%d new or changed)" % (len(objects), len(new_rows)))
+
+# -- -----------------------------------------------------------------
+def update_catalog_refs(db, catalog, model):
+    db.execute("DELETE FROM catalog_ref")
+    for ac in get_asset_columns(model):
+        attr_list = [ c for c in [ac["url"], ac["md5"], ac["bytes"]] if c ]
+        rows = get_entities(catalog, ac["schema"], ac["table"], constraints="!%s::null::" % (urlquote(ac["url"])), keys=["RID"], attr_list=attr_list)
+        refs = []
+        for row in rows:
+            url = row[ac["url"]]
+            if not re.match("^/hatrac/", url): continue
+            refs.append((ac["schema"], ac["table"], ac["url"], row["RID"], url, unversioned_path(url),
+                         row[ac["md5"]] if ac["md5"] else None, row[ac["bytes"]] if ac["bytes"] else None))
+        db.executemany("INSERT OR REPLACE INTO catalog_ref (sname, tname, cname, rid, url, path, md5, bytes) VALUES (?,?,?,?,?,?,?,?)", refs)
+    db.commit()
+
+# -- -----------------------------------------------------------------
+def generate_report(db, namespaces):
+    ns_conditions = [ under_namespace("r.path", ns) for ns in namespaces ]
+    ns_clause = " OR ".join([ condition for condition, params in ns_conditions ])
+    ns_params = [ p for condition, params in ns_conditions for p in params ]
+    report = {
+        "bytes_per_namespace": [
+            {"namespace": ns, "objects": n, "bytes": b, "orphan_objects": on or 0, "orphan_bytes": ob or 0}
+            for ns, n, b, on, ob in db.execute("""
+                SELECT o.namespace, count(*), sum(o.bytes),
+                  sum(CASE WHEN r.path IS NULL THEN 1 END), sum(CASE WHEN r.path IS NULL THEN o.bytes END)
+                FROM hatrac_object o LEFT JOIN (SELECT DISTINCT path FROM catalog_ref) r ON o.path = r.path
+                GROUP BY o.namespace ORDER BY o.namespace""")
+        ],
+        "orphans": [
+            {"path": p, "version_url": v, "bytes": b}
+            for p, v, b in db.execute("""
+                SELECT o.path, o.version_url, o.bytes FROM hatrac_object o
+                WHERE NOT EXISTS (SELECT 1 FROM catalog_ref r WHERE r.path = o.path) ORDER BY o.path""")
+        ],
+        "missing": [
+            {"schema": s, "table": t, "column": c, "RID": rid, "url": u}
+            for s, t, c, rid, u in db.execute("""
+                SELECT r.sname, r.tname, r.cname, r.rid, r.url FROM catalog_ref r
+                WHERE (%s) AND NOT EXISTS (SELECT 1 FROM hatrac_object o WHERE o.path = r.path)
+                ORDER BY r.sname, r.tname, r.rid""" % (ns_clause), ns_params)
+        ],
+    }
+    return report
+
+# -- -----------------------------------------------------------------
+def print_report(report):
+    print("=========== bytes per namespace ============")
+    for e in report["bytes_per_namespace"]:
+        print("%-60s %8d objects %12.2f MiB  (orphans: %d, %.2f MiB)" % (e["namespace"], e["objects"], (e["bytes"] or 0)/(1024*1024), e["orphan_objects"], e["orphan_bytes"]/(1024*1024)))
+    print("=========== orphans: %d ============" % (len(report["orphans"])))
+    for e in report["orphans"]:
+        print("%s (%s bytes)" % (e["version_url"] or e["path"], e["bytes"]))
+    print("=========== missing: %d ============" % (len(report["missing"])))
+    for e in report["missing"]:
+        print("%s:%s.%s RID=%s -> %s" % (e["schema"], e["table"], e["column"], e["RID"], e["url"]))
+
+# -- =================================================================================
+
+def main(server_name, catalog_id, credentials, args):
+    catalog = ErmrestCatalog("https", server_name, catalog_id, credentials)
+    catalog.dcctx['cid'] = DCCTX["cli/read"] + "/hatrac_inventory"
+    store = HatracStore("https", server_name, credentials)
+    store.dcctx['cid'] = DCCTX["cli/read"] + "/hatrac_inventory"
+    model = get_catalog_model(catalog)
+
+    db_file = args.db or os.path.expanduser("~/.deriva/atlas_d2k/hatrac_inventory_%s_%s.sqlite" % (server_name, catalog_id))
+    db = open_inventory(db_file)
+    run = db.execute("INSERT INTO inventory_run (host, catalog_id, namespaces) VALUES (?,?,?)", (server_name, str(catalog_id), json.dumps(args.namespace))).lastrowid
+    db.commit()
+
+    update_hatrac_objects(db, store, args.namespace, run, args.workers, args.full, args.depth)
+    update_catalog_refs(db, catalog, model)
+    report = generate_report(db, args.namespace)
+    print_report(report)
+    if args.report_out:
+        with open(args.report_out, "w") as f:
+            json.dump(report, f, indent=2)
+    db.close()
+
+# -- =================================================================================
+# python -m atlas_d2k.cli.hatrac.inventory --host dev.atlas-d2k.org --namespace /hatrac/resources --report-out inventory.json
+if __name__ == '__main__':
+    cli = AtlasD2KCLI("ATLAS-D2K", None, 1)
+    cli.parser.add_argument('--namespace', metavar='<namespace>', help="hatrac namespace to walk (default=/hatrac). Can be repeated", action="append", default=None)
+    cli.parser.add_argument('--db', metavar='<db>', help="inventory sqlite file (default=~/.deriva/atlas_d2k/hatrac_inventory_<host>_<catalog>.sqlite)", default=None)
+    cli.parser.add_argument('--workers', metavar='<workers>', help="number of concurrent hatrac requests (default=hatrac_walk_workers of the performance profile)", type=int, default=None)
+    cli.parser.add_argument('--depth', metavar='<depth>', help="namespace depth used to summarize bytes (default=3)", type=int, default=3)
+    cli.parser.add_argument('--full', action="store_true", help="fetch the metadata of all objects instead of new objects only", default=False)
+    cli.parser.add_argument('--report-out', metavar='<file>', help="write the report as json", default=None)
+    args = cli.parse_cli()
+    if not args.namespace:
+        args.namespace = ["/hatrac"]
+    credentials = get_credential(args.host, args.credential_file)
+    main(args.host, args.catalog_id, credentials, args)
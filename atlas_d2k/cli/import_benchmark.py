@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import sys
+import os
+import re
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+''' Import-time benchmark of the command line entry points.
+ Every module under atlas_d2k.cli and atlas_d2k.pipelines with a __main__ block is started with
+ --help in a fresh interpreter (median of --runs), and compared with the cost of importing
+ deriva.core alone, which is the floor for any script based on AtlasD2KCLI. With --importtime,
+ the slowest modules reported by python -X importtime are listed for each entry point.
+ This script does not import deriva or atlas_d2k itself, so it does not pay the cost it measures.
+'''
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINT_PACKAGES = ["cli", "pipelines"]
+
+# -- -----------------------------------------------------------------
+# return the module names of all entry points e.g. atlas_d2k.cli.hatrac.inventory
+def find_entry_points(packages=ENTRY_POINT_PACKAGES):
+    modules = []
+    for package in packages:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(PACKAGE_ROOT, package)):
+            dirnames[:] = sorted([ d for d in dirnames if d != "__pycache__" ])
+            for filename in sorted(filenames):
+                if not filename.endswith(".py") or filename == "__init__.py": continue
+                file_path = os.path.join(dirpath, filename)
+                if file_path == os.path.abspath(__file__): continue
+                with open(file_path) as f:
+                    if not re.search(r"^if __name__ == ['\"]__main__['\"]", f.read(), re.M): continue
+                rel_path = os.path.relpath(file_path, os.path.dirname(PACKAGE_ROOT))
+                modules.append(rel_path[:-3].replace(os.sep, "."))
+    return modules
+
+# -- -----------------------------------------------------------------
+def run_python(python_args, env):
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable] + python_args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, p.returncode, p.stderr
+
+# -- -----------------------------------------------------------------
+# median wall time (in seconds) of the command over n runs
+def time_python(python_args, env, runs):
+    # -- untimed first run to warm up the file system cache and write .pyc files
+    seconds, returncode, stderr = run_python(python_args, env)
+    timings = []
+    for i in range(0, runs):
+        seconds, returncode, stderr = run_python(python_args, env)
+        timings.append(seconds)
+    return statistics.median(timings), returncode
+
+# -- -----------------------------------------------------------------
+# parse the output of -X importtime and return the n slowest modules by cumulative time
+#   import time: self [us] | cumulative | imported package
+def slowest_imports(python_args, env, n):
+    seconds, returncode, stderr = run_python(["-X", "importtime"] + python_args, env)
+    imports = []
+    for line in stderr.splitlines():
+        m = re.match(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        if not m: continue
+        imports.append({"module": m[4], "self_ms": int(m[1])/1000, "cumulative_ms": int(m[2])/1000, "depth": len(m[3])//2})
+    # -- top level imports only, nested imports are included in the cumulative time of their parent
+    top_level = [ i for i in imports if i["depth"] == 0 ]
+    return sorted(top_level, key=lambda i: i["cumulative_ms"], reverse=True)[0:n]
+
+# -- -----------------------------------------------------------------
+def benchmark(modules, runs=5, importtime=0):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ p for p in [os.path.dirname(PACKAGE_ROOT), env.get("PYTHONPATH")] if p ])
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    results = {"python": sys.version.split()[0], "runs": runs}
+    results["interpreter_ms"] = time_python(["-c", "pass"], env, runs)[0]*1000
+    results["deriva_core_ms"] = time_python(["-c", "import deriva.core"], env, runs)[0]*1000
+    results["entry_points"] = []
+    for module in modules:
+        seconds, returncode = time_python(["-m", module, "--help"], env, runs)
+        entry = {"module": module, "help_ms": seconds*1000, "over_deriva_ms": seconds*1000 - results["deriva_core_ms"], "returncode": returncode}
+        if importtime:
+            entry["slowest_imports"] = slowest_imports(["-m", module, "--help"], env, importtime)
+        results["entry_points"].append(entry)
+        print("%-60s %8.1f ms" % (module, entry["help_ms"]), file=sys.stderr)
+    return results
+
+# -- -----------------------------------------------------------------
+def print_benchmark(results):
+    print("=========== import time (python %s, median of %d runs) ============" % (results["python"], results["runs"]))
+    print("%-60s %8.1f ms" % ("python -c pass", results["interpreter_ms"]))
+    print("%-60s %8.1f ms" % ("import deriva.core", results["deriva_core_ms"]))
+    print("%-60s %11s %11s" % ("entry point --help", "total", "over deriva"))
+    for e in results["entry_points"]:
+        print("%-60s %8.1f ms %8.1f ms%s" % (e["module"], e["help_ms"], e["over_deriva_ms"], "" if e["returncode"] == 0 else "  (exit %d)" % (e["returncode"])))
+        for i in e.get("slowest_imports", []):
+            print("    %-56s %8.1f ms" % (i["module"], i["cumulative_ms"]))
+
+# -- =================================================================================
+# python -m atlas_d2k.cli.import_benchmark --runs 5 --importtime 10
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the import time of the atlas_d2k command line entry points")
+    parser.add_argument('--module', metavar='<module>', help="entry point module to measure. Can be repeated (default=all)", action="append", default=None)
+    parser.add_argument('--runs', metavar='<runs>', help="number of runs per entry point (default=5)", type=int, default=5)
+    parser.add_argument('--importtime', metavar='<n>', help="list the n slowest top level imports of each entry point (default=0)", type=int, default=0)
+    parser.add_argument('--json', action="store_true", help="print the results as json", default=False)
+    args = parser.parse_args()
+    results = benchmark(args.module or find_entry_points(), runs=args.runs, importtime=args.importtime)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_benchmark(results)
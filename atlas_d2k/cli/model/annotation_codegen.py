@@ -0,0 +1,31 @@
+#!/usr/bin/python
+
+import sys
+from deriva.core import ErmrestCatalog, get_credential
+from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX
+from atlas_d2k.utils.model import get_catalog_model, write_annotation_modules
+
+''' Generate the per-schema annotation scripts from the catalog: one module per annotated
+ schema/table under --out-dir and an index module (__init__.py) importing them lazily.
+ Only the modules whose annotations changed since the last run are regenerated.
+ The generated package can be used as:
+   from <package> import update_annotations, update_schema_annotations
+'''
+
+# -- =================================================================================
+
+def main(server_name, catalog_id, credentials, args):
+    catalog = ErmrestCatalog("https", server_name, catalog_id, credentials)
+    catalog.dcctx['cid'] = DCCTX["cli/read"] + "/annotation_codegen"
+    model = get_catalog_model(catalog)
+    return write_annotation_modules(model, args.out_dir, schema_names=args.schema, source="%s/%s" % (server_name, catalog_id))
+
+# -- =================================================================================
+# python -m atlas_d2k.cli.model.annotation_codegen --host dev.atlas-d2k.org --out-dir annotations --schema Gene_Expression
+if __name__ == '__main__':
+    cli = AtlasD2KCLI("ATLAS-D2K", None, 1)
+    cli.parser.add_argument('--out-dir', metavar='<dir>', help="package directory of the generated modules", required=True)
+    cli.parser.add_argument('--schema', metavar='<schema>', help="schema to generate. Can be repeated (default=all)", action="append", default=None)
+    args = cli.parse_cli()
+    credentials = get_credential(args.host, args.credential_file)
+    main(args.host, args.catalog_id, credentials, args)
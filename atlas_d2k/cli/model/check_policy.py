@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+import sys
+import json
+from deriva.core import ErmrestCatalog, get_credential
+from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX
+from atlas_d2k.utils.model import get_catalog_model
+from atlas_d2k.utils.policy import policy_rules, check_model_policies, policy_report, print_policy_report
+
+''' Check the catalog model against the policy rules in atlas_d2k.utils.policy and report all
+ violations. Exit with status 1 if there is any violation, so it can be used as a pre-deploy check.
+'''
+
+# -- =================================================================================
+
+def main(server_name, catalog_id, credentials, args):
+    catalog = ErmrestCatalog("https", server_name, catalog_id, credentials)
+    catalog.dcctx['cid'] = DCCTX["cli/read"] + "/check_policy"
+    model = get_catalog_model(catalog)
+
+    report = policy_report(check_model_policies(model, args.rule, workers=args.workers))
+    print_policy_report(report)
+    if args.report_out:
+        with open(args.report_out, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+# -- =================================================================================
+# python -m atlas_d2k.cli.model.check_policy --host dev.atlas-d2k.org --workers 4 --report-out policy.json
+if __name__ == '__main__':
+    cli = AtlasD2KCLI("ATLAS-D2K", None, 1)
+    cli.parser.add_argument('--rule', metavar='<rule>', help="rule to check. Can be repeated (default=all)", action="append", default=None, choices=list(policy_rules.keys()))
+    cli.parser.add_argument('--workers', metavar='<workers>', help="number of processes checking schemas in parallel (default=1)", type=int, default=1)
+    cli.parser.add_argument('--report-out', metavar='<file>', help="write the report as json", default=None)
+    args = cli.parse_cli()
+    credentials = get_credential(args.host, args.credential_file)
+    report = main(args.host, args.catalog_id, credentials, args)
+    sys.exit(1 if report["violations"] else 0)
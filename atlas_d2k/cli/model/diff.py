@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import sys
+import json
+from deriva.core import ErmrestCatalog, get_credential
+from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX
+from atlas_d2k.utils.model import get_catalog_model, diff_models
+
+''' Compare the model of two catalogs (e.g. dev vs prod) and report the differences in structure,
+ comments, annotations, acls, and acl_bindings. Elements are aligned by name. Both models are
+ loaded from the local snapshot cache (see get_catalog_model), so only the models that changed
+ since the last run are downloaded. Use --offline to compare the cached snapshots only.
+ Exit with status 1 if there is any difference.
+'''
+
+# -- -----------------------------------------------------------------
+def diff_report(diffs, left_name, right_name):
+    summary = {}
+    for d in diffs:
+        k = "%s %s %s" % (d["node"][0], d["change"], d["aspect"])
+        summary[k] = summary.get(k, 0) + 1
+    return {"left": left_name, "right": right_name, "differences": len(diffs), "summary": summary, "details": diffs}
+
+# -- -----------------------------------------------------------------
+def print_diff_report(report):
+    print("=========== %s vs %s: %d differences ============" % (report["left"], report["right"], report["differences"]))
+    for k, n in sorted(report["summary"].items()):
+        print("  %s: %d" % (k, n))
+    for d in report["details"]:
+        name = ".".join([ str(n) for n in d["node"][1:] ])
+        if d["change"] != "changed":
+            print("%s %s %s" % ("+" if d["change"] == "added" else "-", d["node"][0], name))
+        else:
+            aspect = "%s %s" % (d["aspect"], d["tag"]) if "tag" in d else d["aspect"]
+            print("~ %s %s %s: %s -> %s" % (d["node"][0], name, aspect, json.dumps(d["left"]), json.dumps(d["right"])))
+
+# -- =================================================================================
+
+def main(server_name, catalog_id, credentials, args):
+    other_host = args.other_host or server_name
+    other_catalog_id = args.other_catalog_id or catalog_id
+    other_credentials = credentials if other_host == server_name else get_credential(other_host, args.credential_file)
+    catalog = ErmrestCatalog("https", server_name, catalog_id, credentials)
+    catalog.dcctx['cid'] = DCCTX["cli/read"] + "/model_diff"
+    other_catalog = ErmrestCatalog("https", other_host, other_catalog_id, other_credentials)
+    other_catalog.dcctx['cid'] = DCCTX["cli/read"] + "/model_diff"
+
+    model = get_catalog_model(catalog, offline=args.offline)
+    other_model = get_catalog_model(other_catalog, offline=args.offline)
+    diffs = diff_models(model, other_model, schema_names=args.schema, aspects=args.aspect or ["structure", "comment", "annotations", "acls", "acl_bindings"])
+
+    report = diff_report(diffs, "%s/%s" % (server_name, catalog_id), "%s/%s" % (other_host, other_catalog_id))
+    print_diff_report(report)
+    if args.report_out:
+        with open(args.report_out, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+# -- =================================================================================
+# python -m atlas_d2k.cli.model.diff --host dev.atlas-d2k.org --other-host www.atlas-d2k.org --report-out model_diff.json
+if __name__ == '__main__':
+    cli = AtlasD2KCLI("ATLAS-D2K", None, 1)
+    cli.parser.add_argument('--other-host', metavar='<host>', help="host of the catalog to compare with (default=--host)", default=None)
+    cli.parser.add_argument('--other-catalog-id', metavar='<id>', help="id of the catalog to compare with (default=--catalog-id)", default=None)
+    cli.parser.add_argument('--schema', metavar='<schema>', help="schema to compare. Can be repeated (default=all)", action="append", default=None)
+    cli.parser.add_argument('--aspect', metavar='<aspect>', help="aspect to compare. Can be repeated (default=all)", action="append", default=None, choices=["structure", "comment", "annotations", "acls", "acl_bindings"])
+    cli.parser.add_argument('--offline', action="store_true", help="compare the cached model snapshots without contacting the servers", default=False)
+    cli.parser.add_argument('--report-out', metavar='<file>', help="write the report as json", default=None)
+    args = cli.parse_cli()
+    credentials = get_credential(args.host, args.credential_file)
+    report = main(args.host, args.catalog_id, credentials, args)
+    sys.exit(1 if report["differences"] else 0)
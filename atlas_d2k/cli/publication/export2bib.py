@@ -7,11 +7,11 @@
 ## python3 -m atlas_d2k.cli.publication.export2bib.py --host dev.rebuildingakidney.org --consortium GUDMAP --from-year 2021 --to-year 2021
 
 
-import argparse, calendar
+import calendar
 # from datetime import datetime, timedelta
-from deriva.core import DerivaServer, ErmrestCatalog, get_credential, write_credential
-from deriva.core.ermrest_model import builtin_types, Table, Column, Key, ForeignKey
-from atlas_d2k.utils.shared import DCCTX, AtlasD2KCLI
+from deriva.core import ErmrestCatalog, get_credential
+from deriva.core import urlquote
+from atlas_d2k.utils.shared import DCCTX, AtlasD2KCLI, request
 
 # Fetch month from timestamp
 def getMonth( string ):
@@ -29,7 +29,7 @@ def generatePublicationData(catalog, schema_name, table_name, consortium, from_y
 
     if not consortium: consortium = "any(GUDMAP,RBK)"
     query = "Consortium=%s&Curation_Status=Release&Year::geq::%s&Year::leq::%s@sort(Year::desc::,Month::desc::,Title)" % (consortium, from_year, to_year)
-    resp = catalog.get("/entity/%s:%s/%s" % ("Common","Publication",query))
+    resp = request(catalog, "get", "/entity/%s:%s/%s" % (urlquote(schema_name), urlquote(table_name), query))
     dataset = resp.json()
 
     outfile = open( 'references.bib',mode = 'w', encoding='utf-8-sig', newline='\n' )
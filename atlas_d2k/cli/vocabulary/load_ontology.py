@@ -0,0 +1,35 @@
+#!/usr/bin/python
+
+import sys
+from deriva.core import ErmrestCatalog, get_credential
+from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX
+from atlas_d2k.utils.vocabulary import load_ontology_terms, DEFAULT_TERM_COLUMNS
+
+''' Load the terms of an ontology file (obo or owl, optionally gzipped) into a vocabulary table
+ with ID, URI, Name, Description, and Synonyms columns. Terms are matched on ID: new terms are
+ inserted, changed terms are updated, and unchanged terms are skipped.
+'''
+
+# -- =================================================================================
+
+def main(server_name, catalog_id, credentials, args):
+    catalog = ErmrestCatalog("https", server_name, catalog_id, credentials)
+    catalog.dcctx['cid'] = DCCTX["cli/ingest"] + "/load_ontology"
+    columns = { k: v for k, v in DEFAULT_TERM_COLUMNS.items() if not (k == "synonyms" and args.no_synonyms) }
+    return load_ontology_terms(catalog, args.schema, args.table, args.file, id_prefixes=args.id_prefix, columns=columns,
+                               include_obsolete=args.include_obsolete, batch_rows=args.batch_rows)
+
+# -- =================================================================================
+# python -m atlas_d2k.cli.vocabulary.load_ontology --host dev.atlas-d2k.org --schema Vocabulary --table Anatomy --file uberon.obo --id-prefix UBERON
+if __name__ == '__main__':
+    cli = AtlasD2KCLI("ATLAS-D2K", None, 1)
+    cli.parser.add_argument('--schema', metavar='<schema>', help="schema of the vocabulary table", required=True)
+    cli.parser.add_argument('--table', metavar='<table>', help="vocabulary table", required=True)
+    cli.parser.add_argument('--file', metavar='<file>', help="ontology file (.obo, .owl, optionally .gz)", required=True)
+    cli.parser.add_argument('--id-prefix', metavar='<prefix>', help="only load terms with this id prefix e.g. UBERON. Can be repeated", action="append", default=None)
+    cli.parser.add_argument('--include-obsolete', action="store_true", help="load obsolete terms", default=False)
+    cli.parser.add_argument('--no-synonyms', action="store_true", help="the table has no Synonyms column", default=False)
+    cli.parser.add_argument('--batch-rows', metavar='<n>', help="number of rows per request (default=insert_batch_rows of the performance profile)", type=int, default=None)
+    args = cli.parse_cli()
+    credentials = get_credential(args.host, args.credential_file)
+    main(args.host, args.catalog_id, credentials, args)
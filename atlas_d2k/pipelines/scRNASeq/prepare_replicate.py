@@ -1,19 +1,10 @@
 #!/usr/bin/python
 
-import sys
 import json
 import csv
 import os
-from deriva.core import ErmrestCatalog, AttrDict, get_credential, DEFAULT_CREDENTIAL_FILE, tag, urlquote, DerivaServer, get_credential, BaseCLI, HatracStore
-from deriva.core import urlquote, urlunquote
-from deriva.core.ermrest_model import builtin_types, Schema, Table, Column, Key, ForeignKey, tag, AttrDict
-from atlas_d2k.utils.data import get_entities
-from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX
-#from atlas_d2k.utils.hatrac import 
-import requests.exceptions
-
-
-scratch_dir = "/scratch/scrna"
+from deriva.core import get_credential, urlquote, DerivaServer, HatracStore
+from atlas_d2k.utils.shared import AtlasD2KCLI, DCCTX, get_context, default_context
 
 ''' Given a replicate
  - Create a metadata file in a tsv format?
@@ -22,6 +13,7 @@ scratch_dir = "/scratch/scrna"
 
 
 def get_experiment_settings(catalog, replicate_rid):
+    from atlas_d2k.utils.data import get_entities
     experiment_settings = get_entities(catalog, "RNASeq", "Replicate", constraints="RID=%s/(Experiment_RID)=(RNASeq:Experiment_Settings:Experiment_RID)" % (urlquote(replicate_rid)) )
     
     print(json.dumps(experiment_settings, indent=4))
@@ -49,8 +41,11 @@ def generate_hubmap_metadata(catalog, replicate_rid):
     tsvfile.close()
     
 # -- -----------------------------------------------------------------
-def prepare_replicate_files(catalog, store, replicate_rid):
-    replicate_dir = "%s/%s" % (scratch_dir, replicate_rid)
+# cache: HatracObjectCache of the downloads, or None
+def prepare_replicate_files(catalog, store, replicate_rid, cache=None, ctx=None):
+    from atlas_d2k.utils.data import get_entities
+    from atlas_d2k.utils.hatrac import get_obj_cached
+    replicate_dir = get_context(ctx, catalog).scratch_path("scrna", replicate_rid)
     # create dir structure
     os.makedirs("%s/extras" % (replicate_dir), exist_ok=True)
     fastq_dir = "%s/raw/fastq/RNA" % (replicate_dir)
@@ -61,18 +56,20 @@ def prepare_replicate_files(catalog, store, replicate_rid):
     
     for row in rows:
         file_path = "%s/%s" % (fastq_dir, row["File_Name"])
-        local_file = store.get_obj(row["URI"], destfilename=file_path)
+        get_obj_cached(store, row["URI"], file_path, md5_hex=row.get("MD5"), cache=cache)
         print("Downloaded file: %s -> %s" % (row["URI"], file_path))
 
 
 # -- =================================================================================
         
+# -- the helper modules are imported by the functions that use them, so --help stays fast
 def main(server_name, catalog_id, credentials, args):
+    from atlas_d2k.utils.hatrac import HatracObjectCache
     server = DerivaServer('https', server_name, credentials)
     catalog = server.connect_ermrest(catalog_id)
     store = HatracStore("https", server_name, credentials)
     catalog.dcctx['cid'] = DCCTX["pipeline/seq/scrna"]
-    model = catalog.getCatalogModel()
+    cache = HatracObjectCache(args.cache_dir) if args.cache_dir else None
 
     if args.replicate:
         replicate_rid = args.replicate
@@ -81,17 +78,18 @@ def main(server_name, catalog_id, credentials, args):
     
     #generate_hubmap_metadata(catalog, replicate_rid)
     get_experiment_settings(catalog, replicate_rid)
-    prepare_replicate_files(catalog, store, replicate_rid)
+    prepare_replicate_files(catalog, store, replicate_rid, cache=cache)
     
 
 # -- =================================================================================
-# python -m atlas_d2k.pipelines.scRNASeq.prepare_replicate  --host dev.atlas-d2k.org --scratch /scratch/scrna --replicate 16-2PS4
+# python -m atlas_d2k.pipelines.scRNASeq.prepare_replicate  --host dev.atlas-d2k.org --scratch /scratch/scrna --replicate 16-2PS4 --cache-dir /scratch/hatrac_cache
 if __name__ == '__main__':
     cli = AtlasD2KCLI("ATLAS-D2K", None, 1)
-    cli.parser.add_argument('--scratch', metavar='<scratch>', help="scratch directory path", default=False)
+    cli.parser.add_argument('--scratch', metavar='<scratch>', help="scratch directory path (default=/scratch/scrna)", default=False)
     cli.parser.add_argument('--replicate', metavar='<replicate>', help="replicate rid", default=False)    
+    cli.parser.add_argument('--cache-dir', metavar='<cache_dir>', help="content-addressed download cache directory", default=None)
     args = cli.parse_cli()
     credentials = get_credential(args.host, args.credential_file)
     if args.scratch:
-        scratch_dir = args.scratch
+        default_context.scratch_dirs["scrna"] = args.scratch
     main(args.host, args.catalog_id, credentials, args)
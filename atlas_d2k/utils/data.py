@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
 import sys
+import os
 import json
-from deriva.core import ErmrestCatalog, AttrDict, get_credential, DEFAULT_CREDENTIAL_FILE, tag, urlquote, DerivaServer, get_credential, BaseCLI
-from deriva.core.ermrest_model import builtin_types, Schema, Table, Column, Key, ForeignKey, tag, AttrDict
-from deriva.core import urlquote, urlunquote
-import requests.exceptions
+import re
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from deriva.core import urlquote
+from .shared import get_context, request, traced, trace_operation
 
 system_columns = ["RID", "RCT", "RMT", "RCB", "RMB"]
 # -- =================================================================================
@@ -44,9 +48,13 @@ def approx_json_bytecnt(data):
         raise TypeError('cannot estimate size of unexpected data %r' % data)
 # ---------------------------------------------------------------
 
-def insert_if_not_exist(catalog, schema_name, table_name, payload, defaults=None, batch_size=10000):
+@traced("schema_name", "table_name")
+def insert_if_not_exist(catalog, schema_name, table_name, payload, defaults=None, batch_size=None, batch_bytes=None, ctx=None):
     if not payload:
         return []
+    ctx = get_context(ctx, catalog)
+    batch_size = ctx.cfg.perf("insert_batch_rows", batch_size)
+    batch_bytes = ctx.cfg.perf("insert_batch_bytes", batch_bytes)
 
     if defaults:
         defaults_str = '&defaults=%s' % (','.join(list(map(urlquote, defaults))))
@@ -62,15 +70,17 @@ def insert_if_not_exist(catalog, schema_name, table_name, payload, defaults=None
     while index < payload_len:
         batch = payload[index:index+nrows]
         bytes = approx_json_bytecnt(batch)
-        while bytes > 1000000:
-            nrows = nrows - 1000
+        while bytes > batch_bytes and nrows > 1:
+            nrows = max(1, nrows - 1000)
             batch = payload[index:index+nrows]            
             bytes = approx_json_bytecnt(batch)            
         #print("index=%d nrows=%d bytes=%d" % (index, nrows, bytes))
-        resp = catalog.post(
-            "/entity/%s:%s?onconflict=skip%s" % (urlquote(schema_name), urlquote(table_name), defaults_str),
-            json=batch
-        )
+        # -- onconflict=skip makes the insert idempotent
+        with trace_operation("batch", offset=index, rows=len(batch), bytes=bytes):
+            resp = request(catalog, "post",
+                "/entity/%s:%s?onconflict=skip%s" % (urlquote(schema_name), urlquote(table_name), defaults_str),
+                json=batch, idempotent=True, ctx=ctx
+            )
         inserted.extend(resp.json())
         #print("inserting rows[%d:%d](%d bytes): %s:%s => \n%s " % (index, nrows, bytes, schema_name, table_name, json.dumps(resp.json(), indent=4, sort_keys=True)))        
         #print("  - inserting rows[%d:%d](%d bytes): %s:%s " % (index, index+nrows, bytes, schema_name, table_name))
@@ -80,13 +90,17 @@ def insert_if_not_exist(catalog, schema_name, table_name, payload, defaults=None
     return(inserted)
 
 # ---------------------------------------------------------------
-def update_table_rows(catalog, schema_name, table_name, key="RID", column_names=[], payload=[], batch_size=10000):
-    model = catalog.getCatalogModel()
+@traced("schema_name", "table_name")
+def update_table_rows(catalog, schema_name, table_name, key="RID", column_names=[], payload=[], batch_size=None, batch_bytes=None, ctx=None):
     if not payload:
         return []
+    ctx = get_context(ctx, catalog)
+    batch_size = ctx.cfg.perf("update_batch_rows", batch_size)
+    batch_bytes = ctx.cfg.perf("update_batch_bytes", batch_bytes)
     
     # if updaed_cname is NULL, use all columns except system columns
     if not column_names:
+        model = catalog.getCatalogModel()
         column_names = []
         update_exclude_columns = [key] + ["RID", "RCT", "RMT", "RCB", "RMB"]            
         for cname in  model.schemas[schema_name].tables[table_name].columns.elements:
@@ -106,15 +120,16 @@ def update_table_rows(catalog, schema_name, table_name, key="RID", column_names=
     while index < payload_len:
         batch = payload[index:index+nrows]
         bytes = approx_json_bytecnt(batch)
-        while bytes > 2000000:
-            nrows = nrows - 1000
+        while bytes > batch_bytes and nrows > 1:
+            nrows = max(1, nrows - 1000)
             batch = payload[index:index+nrows]            
             bytes = approx_json_bytecnt(batch)            
         #print("updating rows[%d:%d](%d bytes): %s:%s => \n%s " % (index, nrows, bytes, schema_name, table_name, json.dumps(batch, indent=4, sort_keys=True)))
-        resp = catalog.put(
-            "/attributegroup/%s:%s/%s;%s" % (urlquote(schema_name), urlquote(table_name), urlquote(key), cnames),
-            json=batch
-        )
+        with trace_operation("batch", offset=index, rows=len(batch), bytes=bytes):
+            resp = request(catalog, "put",
+                "/attributegroup/%s:%s/%s;%s" % (urlquote(schema_name), urlquote(table_name), urlquote(key), cnames),
+                json=batch, ctx=ctx
+            )
         updated.extend(resp.json())
         print("  - updated rows[%d:%d](%d bytes): %s:%s " % (index, index+nrows, bytes, schema_name, table_name))
         index = index + nrows
@@ -132,13 +147,14 @@ def get_key_for_dict(keys, row):
     return(tuple(index))
     
 # ---------------------------------------------------------------
-def update_data_if_change(catalog, schema_name, table_name, keys, defaults='', constraints=None, update_columns=None, payload=[], batch_size=10000):
+def update_data_if_change(catalog, schema_name, table_name, keys, defaults='', constraints=None, update_columns=None, payload=[], batch_size=None):
     pass
 
 # ---------------------------------------------------------------
 # TODO: make sure to return the right arrays!
 # constraints is used to check the existing entries in the Ermrest
-def insert_if_exist_update(catalog, schema_name, table_name, keys, defaults=None, payload=[], constraints=None, update_columns=None, batch_size=10000, limit=50000, bypass_insert=False):
+@traced("schema_name", "table_name")
+def insert_if_exist_update(catalog, schema_name, table_name, keys, defaults=None, payload=[], constraints=None, update_columns=None, batch_size=None, limit=50000, bypass_insert=False, ctx=None):
     print("------ insert_if_not_exist ---------")
     #print(json.dumps(payload, indent=4))
     
@@ -152,7 +168,7 @@ def insert_if_exist_update(catalog, schema_name, table_name, keys, defaults=None
     if bypass_insert: # or "RID" in payload[0].keys():    
         print("  - BYPASS INSERT: bypass_insert (%s) is True or RID exist in payload: payload[0]=%s" % (bypass_insert, payload[0]))
     else:
-        inserted = insert_if_not_exist(catalog, schema_name, table_name, payload, defaults, batch_size)
+        inserted = insert_if_not_exist(catalog, schema_name, table_name, payload, defaults, batch_size, ctx=ctx)
         print("  - INSERTED: %d rows inserted" % (len(inserted)))
         #print("  - INSERTED: %d rows inserted: %s" % (len(inserted), json.dumps(inserted, indent=4)))
         if len(payload) == len(inserted):
@@ -189,7 +205,7 @@ def insert_if_exist_update(catalog, schema_name, table_name, keys, defaults=None
             constraints = ";".join(disjunctions)
     print("  - getting existing rows with constraints = %s" % (constraints))
     # -- TODO: check for URL length limitation based on constraints. Retrieve only update_columns instead of all rows
-    existing = get_entities(catalog, schema_name, table_name, constraints=constraints, keys=["RID"], attr_list=attr_list)
+    existing = get_entities(catalog, schema_name, table_name, constraints=constraints, keys=["RID"], attr_list=attr_list, ctx=ctx)
     #print("  - Getting existing rows with constraints %s from ermrest [%d]: %s" % (constraints, len(existing), json.dumps(existing, indent=4)))
     keys2existing = { get_key_for_dict(keys, row) : row for row in existing }
     
@@ -217,21 +233,25 @@ def insert_if_exist_update(catalog, schema_name, table_name, keys, defaults=None
         return(inserted + existed)
     print("  - PARTIAL INSERT: will update %d rows" % (len(update_payload)))
     #print("  - PARTIAL INSERT: will update %d rows: %s" % (len(update_payload), json.dumps(update_payload, indent=4)))
-    updated = update_table_rows(catalog, schema_name, table_name, key="RID", column_names=update_columns, payload=update_payload, batch_size=10000)
+    updated = update_table_rows(catalog, schema_name, table_name, key="RID", column_names=update_columns, payload=update_payload, batch_size=batch_size, ctx=ctx)
     return(inserted + existed + updated)
                            
 # ---------------------------------------------------------------    
-def delete_table_rows(catalog, schema_name, table_name, constraints=''):
+@traced("schema_name", "table_name")
+def delete_table_rows(catalog, schema_name, table_name, constraints='', ctx=None):
 
-    resp = catalog.delete(
-        "/entity/%s:%s%s" % (urlquote(schema_name), urlquote(table_name), constraints)
+    resp = request(catalog, "delete",
+        "/entity/%s:%s%s" % (urlquote(schema_name), urlquote(table_name), constraints), ctx=ctx
     )
     return(resp)
 
 # ---------------------------------------------------------------
 # example of descending order: "RID::desc::"
-def get_entities(catalog, schema_name, table_name, constraints=None, keys=["RID"], attr_list=None, sort=["RID"], limit=None, batch_size=5000):
+@traced("schema_name", "table_name")
+def get_entities(catalog, schema_name, table_name, constraints=None, keys=["RID"], attr_list=None, sort=["RID"], limit=None, batch_size=None, ctx=None):
     payload = []
+    ctx = get_context(ctx, catalog)
+    batch_size = ctx.cfg.perf("read_batch_rows", batch_size)
     if not limit:
         limit = 10000000
     after = []
@@ -248,7 +268,7 @@ def get_entities(catalog, schema_name, table_name, constraints=None, keys=["RID"
         if after: url = "%s@after(%s)" % (url, ",".join( [ urlquote(v) for v in after ]))
         url = "%s?limit=%d" % (url, page_size)
         print("get_entities: url = %s" % (url))
-        rows = catalog.get(url).json()
+        rows = request(catalog, "get", url, ctx=ctx).json()
         payload.extend(rows)
         n = len(rows)
         if len(rows) == 0 or n < batch_size:
@@ -260,17 +280,18 @@ def get_entities(catalog, schema_name, table_name, constraints=None, keys=["RID"
 
 
 # ---------------------------------------------------------------
-def get_key2data_dict(catalog, schema_name, table_name, key="Name", attr_list=["RID"], constraints='', sort=["RID"], limit=None):
+@traced("schema_name", "table_name")
+def get_key2data_dict(catalog, schema_name, table_name, key="Name", attr_list=["RID"], constraints='', sort=["RID"], limit=None, ctx=None):
     key2data_dict = {}
 
     if not attr_list or "*" in attr_list :
-        rows = get_entities(catalog, schema_name, table_name, constraints=constraints)
+        rows = get_entities(catalog, schema_name, table_name, constraints=constraints, ctx=ctx)
     else:
         # format constraint if it doesn't have / before or after
         attr_list_str = ','.join(list(map(urlquote, attr_list)))
         if constraints and not constraints.endswith("/"):
             constraints = "%s/" % constraints 
-        resp = catalog.get("/attributegroup/%s:%s/%s%s;%s" % (urlquote(schema_name), urlquote(table_name), constraints, urlquote(key), attr_list_str))
+        resp = request(catalog, "get", "/attributegroup/%s:%s/%s%s;%s" % (urlquote(schema_name), urlquote(table_name), constraints, urlquote(key), attr_list_str), ctx=ctx)
         rows = resp.json()
     
     key2data_dict = { row[key]: row for row in rows  }
@@ -278,3 +299,177 @@ def get_key2data_dict(catalog, schema_name, table_name, key="Name", attr_list=["
     #if table_name == "Cell_Type": print(key2data_dict)
     return(key2data_dict)
 
+
+# -- =================================================================================
+# -- key resolver
+#
+# KeyResolver maps the values of a key column (e.g. Name or ID of a vocabulary table) to rows
+# (e.g. {"RID": ...}) without downloading the whole table. Missing values are fetched in
+# chunked key=ANY(...) queries, and results (including values not found) are kept in an LRU
+# that is saved on disk per host/catalog/table, so it is reused across scripts and runs.
+# Freshness is checked at most every ttl seconds with one aggregate request (row count and max
+# RMT). If the table changed, the modified rows are fetched and applied to the cache. If rows
+# were deleted, the cache is cleared.
+# A resolver can be shared by threads: resolve, save, and the freshness check hold its lock.
+#
+DEFAULT_KEY_CACHE_DIR = os.path.expanduser("~/.deriva/atlas_d2k/keys")
+
+class KeyResolver():
+    def __init__(self, catalog, schema_name, table_name, key="Name", attr_list=["RID"], max_entries=100000, ttl=60, max_url_chars=4000, cache_dir=DEFAULT_KEY_CACHE_DIR, ctx=None):
+        self.catalog = catalog
+        self.ctx = get_context(ctx, catalog)
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.key = key
+        self.attr_list = [ c for c in ["RID"] + list(attr_list) if c != key ]
+        self.attr_list = sorted(set(self.attr_list), key=self.attr_list.index)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_url_chars = max_url_chars
+        self.rows = OrderedDict()       # key value -> row or None if not found. Least recently used first
+        self.state = None               # {"cnt": row count, "max_rmt": max RMT} of the table
+        self.checked = 0
+        self.lock = threading.RLock()
+        self.cache_file = None
+        if cache_dir:
+            self.cache_file = os.path.join(cache_dir, "%s_%s_%s_%s_%s.json" % (catalog._server, catalog.catalog_id, schema_name, table_name, key))
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_file): return self
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if cache["attr_list"] == self.attr_list:
+                self.rows = OrderedDict([ (v, row) for v, row in cache["rows"] ])
+                self.state = cache["state"]
+        except (OSError, ValueError, KeyError) as e:
+            print("WARNING: ignore unreadable key cache %s: %s" % (self.cache_file, e))
+        return self
+
+    def save(self):
+        if not self.cache_file: return
+        with self.lock:
+            cache = {"attr_list": self.attr_list, "state": self.state, "rows": list(self.rows.items())}
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = "%s.%d.%d.tmp" % (self.cache_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def clear(self):
+        with self.lock:
+            self.rows = OrderedDict()
+
+    def table_state(self):
+        rows = request(self.catalog, "get", "/aggregate/%s:%s/cnt:=cnt(*),max_rmt:=max(RMT)" % (urlquote(self.schema_name), urlquote(self.table_name)), ctx=self.ctx).json()
+        return {"cnt": rows[0]["cnt"], "max_rmt": rows[0]["max_rmt"]}
+
+    def check_freshness(self, force=False):
+        with self.lock:
+            self.check_freshness_locked(force)
+
+    def check_freshness_locked(self, force=False):
+        if not force and time.time() - self.checked < self.ttl: return
+        state = self.table_state()
+        self.checked = time.time()
+        if state == self.state: return
+        if self.state is None or self.state["max_rmt"] is None or state["max_rmt"] is None or state["cnt"] < self.state["cnt"]:
+            self.clear()
+        else:
+            modified = get_entities(self.catalog, self.schema_name, self.table_name, constraints="RMT::gt::%s" % (urlquote(self.state["max_rmt"])),
+                                    keys=[self.key], attr_list=self.attr_list + ["RCT"], ctx=self.ctx)
+            max_rmt = parse_timestamp(self.state["max_rmt"])
+            created = [ row for row in modified if parse_timestamp(row["RCT"]) > max_rmt ]
+            if state["cnt"] != self.state["cnt"] + len(created):
+                # -- some rows were deleted
+                self.clear()
+            else:
+                rid2value = { row["RID"]: v for v, row in self.rows.items() if row }
+                for row in modified:
+                    if row["RID"] in rid2value: self.rows.pop(rid2value[row["RID"]], None)
+                    row.pop("RCT")
+                    if row[self.key] in self.rows: self.rows[row[self.key]] = row
+        self.state = state
+        self.save()
+
+    # split values so that each key=ANY(...) constraint stays within max_url_chars
+    def chunk_values(self, values):
+        chunk, nchars = [], 0
+        for v in values:
+            quoted = urlquote(str(v))
+            if chunk and nchars + len(quoted) + 1 > self.max_url_chars:
+                yield chunk
+                chunk, nchars = [], 0
+            chunk.append(v)
+            nchars += len(quoted) + 1
+        if chunk:
+            yield chunk
+
+    # return {value: row} for the values found in the table
+    @traced()
+    def resolve(self, values):
+        with self.lock:
+            return self.resolve_locked(values)
+
+    def resolve_locked(self, values):
+        self.check_freshness()
+        values = list(OrderedDict.fromkeys([ v for v in values if v is not None ]))
+        missing = [ v for v in values if v not in self.rows ]
+        for chunk in self.chunk_values(missing):
+            constraints = "%s=ANY(%s)" % (urlquote(self.key), ",".join([ urlquote(str(v)) for v in chunk ]))
+            found = { row[self.key]: row for row in get_entities(self.catalog, self.schema_name, self.table_name, constraints=constraints, keys=[self.key], attr_list=self.attr_list, ctx=self.ctx) }
+            for v in chunk:
+                self.rows[v] = found.get(v)
+        result = {}
+        for v in values:
+            self.rows.move_to_end(v)
+            if self.rows[v] is not None: result[v] = self.rows[v]
+        while len(self.rows) > self.max_entries:
+            self.rows.popitem(last=False)
+        if missing:
+            self.save()
+        return result
+
+# ---------------------------------------------------------------
+# ermrest timestamptz values e.g. 2023-03-12T01:30:00.123456-08:00 are compared as datetimes,
+# since the utc offset of the strings can differ (e.g. across a DST change).
+# ermrest drops the trailing zeros of the fraction (e.g. 01:30:00.12-08:00), which fromisoformat
+# rejects before python 3.11, so the fraction is padded to 6 digits.
+def parse_timestamp(value):
+    value = re.sub("\\.([0-9]+)", lambda m: "." + (m[1] + "000000")[0:6], value)
+    return datetime.fromisoformat(re.sub("([+-][0-9]{2})$", "\\1:00", value))
+
+# ---------------------------------------------------------------
+# resolvers are cached in the context of the catalog
+def get_key_resolver(catalog, schema_name, table_name, key="Name", attr_list=["RID"], ctx=None):
+    ctx = get_context(ctx, catalog)
+    resolver_key = (catalog._server, catalog.catalog_id, schema_name, table_name, key, tuple(attr_list))
+    return ctx.get_cached("key_resolvers", resolver_key, lambda: KeyResolver(catalog, schema_name, table_name, key=key, attr_list=attr_list, ctx=ctx))
+
+# ---------------------------------------------------------------
+# Replace key values in the fkey columns of a payload with the referenced values, in place.
+# fkeys maps a payload column to (schema_name, table_name, key, referenced column) e.g.
+#   fill_fkeys(catalog, payload, {"Species": ("Vocabulary", "Species", "Name", "ID")})
+# replaces species names by species IDs. Values already equal to the referenced column are
+# kept. Return the values that could not be resolved: [(row index, column, value)]
+@traced()
+def fill_fkeys(catalog, payload, fkeys, ctx=None):
+    unresolved = []
+    for cname, (schema_name, table_name, key, referenced_cname) in fkeys.items():
+        resolver = get_key_resolver(catalog, schema_name, table_name, key, [referenced_cname], ctx=ctx)
+        values = [ row.get(cname) for row in payload ]
+        found = resolver.resolve(values)
+        if referenced_cname != key:
+            missing = [ v for v in values if v is not None and v not in found ]
+            referenced = get_key_resolver(catalog, schema_name, table_name, referenced_cname, [referenced_cname], ctx=ctx).resolve(missing) if missing else {}
+        else:
+            referenced = {}
+        for index, row in enumerate(payload):
+            v = row.get(cname)
+            if v is None: continue
+            if v in found:
+                row[cname] = found[v][referenced_cname]
+            elif v not in referenced:
+                unresolved.append((index, cname, v))
+    return unresolved
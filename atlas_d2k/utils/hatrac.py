@@ -3,12 +3,28 @@ import json
 import os
 import re
 import binascii
+import hashlib
+import base64
+import shutil
+import time
+import fcntl
 import requests
-from deriva.core import ErmrestCatalog, HatracStore, AttrDict, get_credential, DEFAULT_CREDENTIAL_FILE, tag, urlquote, urlunquote, DerivaServer, get_credential, BaseCLI, format_exception, NotModified, DEFAULT_HEADERS, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CHUNK_LIMIT, DEFAULT_MAX_REQUEST_SIZE, Megabyte, get_transfer_summary, calculate_optimal_transfer_shape, DEFAULT_SESSION_CONFIG
-from deriva.core.ermrest_model import builtin_types, Schema, Table, Column, Key, ForeignKey
-from deriva.core.utils.hash_utils import compute_file_hashes
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+from deriva.core import urlquote, DEFAULT_HEADERS, DEFAULT_CHUNK_SIZE, Megabyte
+from .data import get_entities
+from .shared import get_context, request, call_with_retry, binding_host, traced, trace_headers
 
-processing_dir = "/scratch/hatrac"
+# -- read size used when hashing local files
+HASH_READ_SIZE = 8 * Megabyte
+# -- persistent cache of local file digests, see compute_files_digests
+DEFAULT_DIGEST_CACHE_FILE = os.path.expanduser("~/.deriva/atlas_d2k/file_digests.json")
+# -- content-addressed cache of downloaded hatrac objects, see HatracObjectCache
+DEFAULT_OBJECT_CACHE_DIR = "/scratch/hatrac_cache"
+DEFAULT_OBJECT_CACHE_BYTES = 200 * 1024 * Megabyte
+# -- free space to leave on the staging volume, see StagingArea
+DEFAULT_STAGING_RESERVE_BYTES = 1024 * Megabyte
 
 '''
 store = HatracStore('https', servername)
@@ -57,7 +73,7 @@ def get_hatrac_metadata(store, object_path):
 
     # this works if you can read the object
     try:
-        resp = store.head(object_path)
+        resp = request(store, "head", object_path)
     except requests.HTTPError as e:
         #print("ERROR: e.response=%s" % (e.response))
         return None
@@ -159,17 +175,20 @@ def chunk_upload(store,
 
 # --------------------------------------------------------------------------------
 
-def upload_file(from_store, to_store, row, c_name, c_url, c_md5, c_bytes):
+@traced("row.RID", "c_url")
+def upload_file(from_store, to_store, row, c_name, c_url, c_md5, c_bytes, cache=None, staging=None, chunk_size=None, dedup=None, ctx=None):
     # if the url is not in hatrac, return. Don't know how to handle
     if not row[c_url] or not re.match("^/hatrac/", row[c_url]):
         return None
     try:
         to_properties = get_hatrac_metadata(to_store, row[c_url])
-        if to_properties["content-md5"] == row[c_md5]:
+        if to_properties["content-md5"] == hex_to_base64(row[c_md5]):
             return row
     except Exception as e:
         pass
     
+    ctx = get_context(ctx, to_store)
+    chunk_size = ctx.cfg.perf("hatrac_chunk_bytes", chunk_size)
     #from_store_name = re.match("https://(.*)$", from_store.get_server_uri())[1]    
     #to_store_name = re.match("https://(.*)$", to_store.get_server_uri())[1]
     rid = row["RID"]
@@ -183,41 +202,572 @@ def upload_file(from_store, to_store, row, c_name, c_url, c_md5, c_bytes):
         row[c_name] = "%s_%s%s" % (rid, re.match("(.*)_(File|Name)$", c_name)[1], file_ext)
         print("- WARNING: %s is missing. Will assign %s" % (c_name, row[c_name]))
     file_name = sanitize_filename(row[c_name])
-    file_path = "%s/%s_%s" % (processing_dir, rid, file_name)
     md5_hex = row[c_md5]
     md5_base64 = hex_to_base64(md5_hex)
-    file_mb = int(row[c_bytes])/(1024*1024)
-    file_url_base = re.match("^([^:]+)", file_url)[1]    
-    print("  -- rid: %s, name: %s, url: %s, path: %s, md5_hex: %s, md5_base64: %s bytes: %.2f MiB --" % (rid, file_name, file_url, file_path, md5_hex, md5_base64, row[c_bytes]/(1024*1024)))
+    file_bytes = int(properties.get("content-length") or row[c_bytes] or 0)
+    file_url_base = re.match("^([^:]+)", file_url)[1]
+    if not staging:
+        staging = get_default_staging(ctx)
 
-    local_resp = from_store.get_obj(file_url, destfilename=file_path)
+    # -- hatrac md5 is authoritative. The ermrest entry might be incorrect (see below)
+    if "content-md5" in properties.keys():
+        cache_md5_hex = base64_to_hex(properties["content-md5"])
+    else:
+        cache_md5_hex = None
 
+    # -- the same content already exists in to_store under another path. Reuse it.
+    if dedup and cache_md5_hex:
+        existing_url = dedup.lookup_verified(to_store, cache_md5_hex)
+        if existing_url:
+            print("  -- rid: %s, name: %s, url: %s: reuse existing object %s --" % (rid, file_name, file_url, existing_url))
+            row[c_url] = existing_url
+            row[c_md5] = cache_md5_hex
+            row[c_bytes] = file_bytes
+            return row
+
+    if ctx.cfg.dry_run:
+        download_bytes = 0 if cache and cache.lookup(cache_md5_hex) else file_bytes
+        ctx.cost_estimate.add_transfer(download_bytes, file_bytes)
+        print("  -- rid: %s, name: %s, url: %s: dry run (%.2f MiB) --" % (rid, file_name, file_url, file_bytes/(1024*1024)))
+        return row
+
+    # -- the staged file is removed and its bytes released even when the transfer fails. A file
+    # that can't be staged (StagingSpaceError) fails alone, like the other per-file errors.
     try:
-        if "content-encoding" in properties.keys():
-            # one option is not to check
-            #md5_base64 = None # don't check
-            raise Exception("ERROR: content-encoding is not expected")
-        else:
-            if "content-md5" not in properties.keys():
-                print("  - ERROR: MISSING MD5: %s -> %s " % (from_store._server_uri, json.dumps(properties, indent=4)))
-            elif properties["content-md5"] != md5_base64:
-                print("  - ERROR: INCORRECT ERMrest entry [%s]: %s instead of %s" % (c_md5, properties["content-md5"], md5_base64))
-                md5_base64 = properties["content-md5"]
-                md5_hex = base64_to_hex(md5_base64)
-                row[c_md5] = md5_hex
-            if "content-length" in properties.keys() and int(properties["content-length"]) != row[c_bytes]:
-                print("  - ERROR: INCORRECT ermrest entries [%s]: %s instead of %s" % (c_bytes, properties["content-length"], row[c_bytes]))
-                row[c_bytes] = int(properties["content-length"])
-            
-            hatrac_url = to_store.put_loc(file_url_base, file_path, md5=md5_base64, content_disposition="filename*=UTF-8''%s" % (file_name),
-                                          chunked=True, chunk_size=chunk_size)
-            row[c_url] = hatrac_url
+        with staging.stage(file_bytes, "%s_%s" % (rid, file_name)) as file_path:
+            print("  -- rid: %s, name: %s, url: %s, path: %s, md5_hex: %s, md5_base64: %s bytes: %.2f MiB --" % (rid, file_name, file_url, file_path, md5_hex, md5_base64, file_bytes/(1024*1024)))
+            if "content-encoding" in properties.keys():
+                # one option is not to check
+                #md5_base64 = None # don't check
+                raise Exception("ERROR: content-encoding is not expected")
+            else:
+                get_obj_cached(from_store, file_url, file_path, md5_hex=cache_md5_hex, cache=cache)
+                if "content-md5" not in properties.keys():
+                    print("  - ERROR: MISSING MD5: %s -> %s " % (from_store._server_uri, json.dumps(properties, indent=4)))
+                elif properties["content-md5"] != md5_base64:
+                    print("  - ERROR: INCORRECT ERMrest entry [%s]: %s instead of %s" % (c_md5, properties["content-md5"], md5_base64))
+                    md5_base64 = properties["content-md5"]
+                    md5_hex = base64_to_hex(md5_base64)
+                    row[c_md5] = md5_hex
+                if "content-length" in properties.keys() and int(properties["content-length"]) != row[c_bytes]:
+                    print("  - ERROR: INCORRECT ermrest entries [%s]: %s instead of %s" % (c_bytes, properties["content-length"], row[c_bytes]))
+                    row[c_bytes] = int(properties["content-length"])
+
+                hatrac_url = call_with_retry(to_store.put_loc, file_url_base, file_path, md5=md5_base64, content_disposition="filename*=UTF-8''%s" % (file_name),
+                                             chunked=True, chunk_size=chunk_size, headers=trace_headers(), host=binding_host(to_store), idempotent=False, ctx=ctx, admission=False)
+                row[c_url] = hatrac_url
+                if dedup:
+                    dedup.add(md5_hex, hatrac_url)
     except Exception as e:
         row = None
         print("%s" % (e))
-    finally:
-        local_resp.close()
-        clean_up(processing_dir)    
     return(row)
 
+# --------------------------------------------------------------------------------
+# copy the files of many rows between stores. Rows are packed into staging windows that fit
+# within the staging budget and the rows of a window are transferred concurrently.
+# With read_ahead > 1, the next windows are started before the current one completes; their
+# transfers wait in staging.reserve until space is released.
+# return the list of rows as returned by upload_file (None for failed or skipped rows)
+@traced()
+def upload_files(from_store, to_store, rows, c_name, c_url, c_md5, c_bytes, cache=None, staging=None, workers=None, chunk_size=None, dedup=None, read_ahead=None, ctx=None):
+    ctx = get_context(ctx, to_store)
+    workers = ctx.cfg.perf("hatrac_workers", workers)
+    chunk_size = ctx.cfg.perf("hatrac_chunk_bytes", chunk_size)
+    read_ahead = ctx.cfg.perf("hatrac_read_ahead", read_ahead)
+    if not staging:
+        staging = get_default_staging(ctx)
+    results = []
+    in_flight = []
+    windows = staging.plan_windows(rows, c_bytes)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, window in enumerate(windows):
+            print("** upload_files: window %d/%d: %d rows (%.2f MiB)" % (i+1, len(windows), len(window), sum([int(r[c_bytes] or 0) for r in window])/(1024*1024)))
+            in_flight.append([ executor.submit(upload_file, from_store, to_store, row, c_name, c_url, c_md5, c_bytes, cache=cache, staging=staging, chunk_size=chunk_size, dedup=dedup, ctx=ctx) for row in window ])
+            if len(in_flight) >= read_ahead:
+                results.extend([ f.result() for f in in_flight.pop(0) ])
+        for futures in in_flight:
+            results.extend([ f.result() for f in futures ])
+    return results
+
+# ===================================================================================
+# -- local file hashing
+# computes md5, sha256 and size of a file in a single read. The digests are returned in
+# the same (hex, base64) form as deriva.core.utils.hash_utils.compute_file_hashes e.g.
+#   { "md5": (hex, base64), "sha256": (hex, base64), "bytes": 1024 }
+#
+def compute_file_digests(file_path, read_size=HASH_READ_SIZE):
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    nbytes = 0
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+            sha256.update(view[:n])
+            nbytes += n
+    return {
+        "md5": (md5.hexdigest(), base64.b64encode(md5.digest()).decode("utf-8")),
+        "sha256": (sha256.hexdigest(), base64.b64encode(sha256.digest()).decode("utf-8")),
+        "bytes": nbytes,
+    }
+
+# ----------------------------------------------------------
+# a cached digest is valid as long as the path, size, mtime and inode are unchanged
+def file_digest_key(file_path):
+    st = os.stat(file_path)
+    return (os.path.abspath(file_path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+# ----------------------------------------------------------
+def load_digest_cache(cache_file):
+    cache = {}
+    if not cache_file or not os.path.exists(cache_file):
+        return cache
+    try:
+        with open(cache_file) as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        print("WARNING: ignore unreadable digest cache %s: %s" % (cache_file, e))
+        return cache
+    for e in entries:
+        key = (e["path"], e["bytes"], e["mtime_ns"], e["inode"])
+        cache[key] = {"md5": tuple(e["md5"]), "sha256": tuple(e["sha256"]), "bytes": e["bytes"]}
+    return cache
+
+# ----------------------------------------------------------
+# write to a temporary file first so a crash never leaves a truncated cache behind
+def save_digest_cache(cache_file, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    entries = []
+    for (path, nbytes, mtime_ns, inode), digests in cache.items():
+        entries.append({"path": path, "bytes": nbytes, "mtime_ns": mtime_ns, "inode": inode,
+                        "md5": list(digests["md5"]), "sha256": list(digests["sha256"])})
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp_file, cache_file)
+
+# ----------------------------------------------------------
+# compute digests of many files across a process pool. Files whose (path, size, mtime, inode)
+# are found in the cache are not read again. Stale entries of the hashed files are replaced.
+# Set cache_file=None to disable the persistent cache.
+# return: { file_path: {"md5": (hex, base64), "sha256": (hex, base64), "bytes": n} }
+def compute_files_digests(file_paths, workers=None, cache_file=DEFAULT_DIGEST_CACHE_FILE, read_size=HASH_READ_SIZE):
+    cache = load_digest_cache(cache_file)
+    results = {}
+    todo = {}
+    for file_path in file_paths:
+        key = file_digest_key(file_path)
+        if key in cache:
+            results[file_path] = cache[key]
+        else:
+            todo[file_path] = key
+    if not todo:
+        return results
+
+    paths = list(todo.keys())
+    if workers == 1 or len(paths) == 1:
+        digests_list = [compute_file_digests(p, read_size) for p in paths]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            digests_list = list(executor.map(compute_file_digests, paths, [read_size]*len(paths)))
+
+    hashed_paths = {key[0] for key in todo.values()}
+    for key in [k for k in cache.keys() if k[0] in hashed_paths]:
+        del cache[key]
+    for file_path, digests in zip(paths, digests_list):
+        cache[todo[file_path]] = digests
+        results[file_path] = digests
+    if cache_file:
+        save_digest_cache(cache_file, cache)
+    return results
+
+# ----------------------------------------------------------
+# compute digests of all files under root_dir. Return { file_path: digests }
+def compute_tree_digests(root_dir, workers=None, cache_file=DEFAULT_DIGEST_CACHE_FILE, read_size=HASH_READ_SIZE):
+    file_paths = []
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        for file_name in file_names:
+            file_paths.append(os.path.join(dir_path, file_name))
+    return compute_files_digests(sorted(file_paths), workers=workers, cache_file=cache_file, read_size=read_size)
+
+# ===================================================================================
+# -- local object cache
+# HatracObjectCache keeps a copy of downloaded objects under cache_dir/<md5[0:2]>/<md5> and
+# evicts the least recently used objects once the total size exceeds max_bytes. The total is
+# scanned once and then kept up to date by add() and evict(); other processes sharing cache_dir
+# are accounted for at the next eviction, which rescans the directory.
+# A cache hit is materialized at the destination by reflink or hardlink, falling back
+# to a copy only when neither is supported (e.g. across file systems).
+# NOTE: a hardlinked file shares its content with the cache. Do not modify it in place.
+#
+FICLONE = 0x40049409    # linux ioctl to clone (reflink) a file on btrfs/xfs
+
+class HatracObjectCache():
+    cache_dir = None
+    max_bytes = None
+
+    def __init__(self, cache_dir=DEFAULT_OBJECT_CACHE_DIR, max_bytes=DEFAULT_OBJECT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, md5_hex):
+        md5_hex = md5_hex.lower()
+        return os.path.join(self.cache_dir, md5_hex[0:2], md5_hex)
+
+    # return the cached path of the object or None. Mark the object as recently used.
+    def lookup(self, md5_hex):
+        if not md5_hex:
+            return None
+        cache_path = self.path_for(md5_hex)
+        try:
+            st = os.stat(cache_path)
+            # only touch atime, so the mtime of the hardlinked copies stays the same
+            os.utime(cache_path, ns=(time.time_ns(), st.st_mtime_ns))
+        except FileNotFoundError:
+            return None
+        return cache_path
+
+    # materialize the cached object at dest_path. Return True on a cache hit.
+    def materialize(self, md5_hex, dest_path):
+        cache_path = self.lookup(md5_hex)
+        if not cache_path:
+            return False
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        link_file(cache_path, dest_path)
+        return True
+
+    # add a local file to the cache. The file is linked, not copied, when possible.
+    def add(self, file_path, md5_hex=None):
+        if not md5_hex:
+            md5_hex = compute_file_digests(file_path)["md5"][0]
+        cache_path = self.path_for(md5_hex)
+        if os.path.exists(cache_path):
+            return cache_path
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = "%s.%d.%d.tmp" % (cache_path, os.getpid(), threading.get_ident())
+        link_file(file_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += os.path.getsize(cache_path)
+        self.evict()
+        return cache_path
+
+    # return a list of (atime, bytes, path) of the cached objects
+    def entries(self):
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"): continue
+                cache_path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(cache_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_atime_ns, st.st_size, cache_path))
+        return entries
+
+    # remove least recently used objects until the cache fits within max_bytes.
+    # The directory is only scanned when the running total exceeds max_bytes (or is not known yet).
+    def evict(self):
+        with self.lock:
+            if self.total_bytes is not None and self.total_bytes <= self.max_bytes:
+                return []
+            entries = self.entries()
+            total = sum([e[1] for e in entries])
+            evicted = []
+            for atime, nbytes, cache_path in sorted(entries):
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(cache_path)
+                except FileNotFoundError:
+                    pass
+                total -= nbytes
+                evicted.append(cache_path)
+            self.total_bytes = total
+            return evicted
+
+# ----------------------------------------------------------
+# create dest_path with the same content as src_path by reflink, hardlink, or copy (in that order).
+# dest_path must not exist: it is created exclusively, so an existing file (which may be a hardlink
+# of a file in use elsewhere) is never truncated. Raise FileExistsError otherwise.
+def link_file(src_path, dest_path):
+    with open(src_path, "rb") as src, open(dest_path, "xb") as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    # -- remove the empty file created above
+    os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+        return "hardlink"
+    except OSError:
+        pass
+    shutil.copyfile(src_path, dest_path)
+    return "copy"
+
+# ----------------------------------------------------------
+# download a hatrac object to file_path unless an identical copy (by md5) is already in the cache.
+# Newly downloaded objects are added to the cache.
+@traced("file_url")
+def get_obj_cached(store, file_url, file_path, md5_hex=None, cache=None, ctx=None):
+    if cache and cache.materialize(md5_hex, file_path):
+        print("  - cache hit: %s -> %s" % (file_url, file_path))
+        return file_path
+    resp = call_with_retry(store.get_obj, file_url, destfilename=file_path, headers=trace_headers(), host=binding_host(store), ctx=get_context(ctx, store), admission=False)
+    resp.close()
+    if cache:
+        cache.add(file_path, md5_hex)
+    return file_path
+
+# ===================================================================================
+# -- staging area
+class StagingSpaceError(Exception):
+    """ Exception when a transfer can not fit in the staging area.
+    """
+    pass
+
+# ----------------------------------------------------------
+# StagingArea admits local transfers only when their bytes fit within the budget of the staging
+# directory. A transfer reserves its bytes before the file is written and releases them after
+# the file is removed. Concurrent transfers block until enough bytes are released.
+# The budget is the current free space of the volume less reserve_bytes, plus the bytes already
+# written to the staged files (free space excludes them, but they are part of the reservations),
+# capped by max_bytes if specified. Free space is read again on every check, since other writers
+# (e.g. the object cache on the same volume) change it.
+#
+class StagingArea():
+    staging_dir = None
+    max_bytes = None
+    reserve_bytes = None
+    reserved = 0
+
+    def __init__(self, staging_dir=None, max_bytes=None, reserve_bytes=DEFAULT_STAGING_RESERVE_BYTES):
+        self.staging_dir = staging_dir or get_context().scratch_path("hatrac")
+        self.reserve_bytes = reserve_bytes
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.staged = {}        # file path -> reserved bytes of the files being staged
+        self._cond = threading.Condition()
+
+    # bytes that can be written to the volume now, independent of the reservations
+    def free_bytes(self):
+        return shutil.disk_usage(self.staging_dir).free - self.reserve_bytes
+
+    # bytes of the reservations already written to the staged files
+    def written_bytes(self):
+        written = 0
+        for file_path, nbytes in list(self.staged.items()):
+            try:
+                written += min(os.path.getsize(file_path), nbytes)
+            except OSError:
+                pass
+        return written
+
+    # total bytes that can be reserved now, including the current reservations
+    def budget(self):
+        budget = max(self.free_bytes(), 0) + self.written_bytes()
+        return budget if self.max_bytes is None else min(budget, self.max_bytes)
+
+    def fits(self, nbytes):
+        return self.reserved + nbytes <= self.budget()
+
+    # block until nbytes can be reserved. Raise StagingSpaceError if it can never fit.
+    def reserve(self, nbytes, timeout=None):
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            raise StagingSpaceError("ERROR: %d bytes exceed staging budget %d of %s" % (nbytes, self.max_bytes, self.staging_dir))
+        started = time.time()
+        with self._cond:
+            while not self.fits(nbytes):
+                # -- nothing to wait for if we hold no reservation
+                if self.reserved == 0:
+                    raise StagingSpaceError("ERROR: %d bytes exceed free space of %s" % (nbytes, self.staging_dir))
+                remaining = None if timeout is None else timeout - (time.time() - started)
+                if remaining is not None and remaining <= 0:
+                    raise StagingSpaceError("ERROR: timeout waiting for %d bytes in %s" % (nbytes, self.staging_dir))
+                # -- wake up periodically, since the free space can change without a release
+                self._cond.wait(1 if remaining is None else min(1, remaining))
+            self.reserved += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.reserved = max(self.reserved - nbytes, 0)
+            self._cond.notify_all()
+
+    # reserve nbytes and yield a file path in the staging directory. The file is always
+    # removed and the bytes released on exit.
+    @contextmanager
+    def stage(self, nbytes, file_name, timeout=None):
+        self.reserve(nbytes, timeout)
+        file_path = os.path.join(self.staging_dir, file_name)
+        with self._cond:
+            self.staged[file_path] = nbytes
+        try:
+            yield file_path
+        finally:
+            remove_file(file_path)
+            with self._cond:
+                self.staged.pop(file_path, None)
+            self.release(nbytes)
+
+    # pack rows into windows whose total bytes fit within the budget (first fit decreasing),
+    # so many small objects share a window with a large one.
+    def plan_windows(self, rows, c_bytes, max_rows=None):
+        budget = self.budget()
+        windows = []
+        window_bytes = []
+        for row in sorted(rows, key=lambda r: int(r[c_bytes] or 0), reverse=True):
+            nbytes = int(row[c_bytes] or 0)
+            for i, window in enumerate(windows):
+                if window_bytes[i] + nbytes <= budget and (not max_rows or len(window) < max_rows):
+                    window.append(row)
+                    window_bytes[i] += nbytes
+                    break
+            else:
+                windows.append([row])
+                window_bytes.append(nbytes)
+        return windows
+
+    # remove left-over files e.g. from a previous run that was killed
+    def clean_up(self):
+        for file_name in os.listdir(self.staging_dir):
+            remove_file(os.path.join(self.staging_dir, file_name))
+
+# ----------------------------------------------------------
+def remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+# ----------------------------------------------------------
+# the staging area of the hatrac scratch directory of the context. Contexts with the same
+# scratch directory share its staging area, so the budget of the volume is not counted twice.
+staging_areas = {}
+staging_lock = threading.Lock()
+
+def get_default_staging(ctx=None):
+    staging_dir = get_context(ctx).scratch_path("hatrac")
+    with staging_lock:
+        if staging_dir not in staging_areas:
+            staging_areas[staging_dir] = StagingArea(staging_dir)
+        return staging_areas[staging_dir]
+
+# ===================================================================================
+# -- cross-path deduplication
+# HatracDedupIndex maps md5 (hex) to an existing versioned hatrac url. It is built from the
+# asset columns of a catalog (see model.get_asset_columns) and kept up to date by upload_file.
+#
+class HatracDedupIndex():
+    md5_to_url = None
+
+    def __init__(self):
+        self.md5_to_url = {}
+        self._lock = threading.Lock()
+
+    # load md5 -> url from all asset tables with an md5 column. Only versioned urls are kept.
+    def build(self, catalog, asset_columns):
+        for ac in asset_columns:
+            if not ac["md5"]: continue
+            rows = get_entities(catalog, ac["schema"], ac["table"], constraints="!%s::null::" % (urlquote(ac["url"])),
+                                keys=["RID"], attr_list=[ac["url"], ac["md5"]])
+            for row in rows:
+                self.add(row[ac["md5"]], row[ac["url"]])
+        print("HatracDedupIndex: %d distinct objects from %d asset columns" % (len(self.md5_to_url), len(asset_columns)))
+        return self
+
+    def add(self, md5_hex, url):
+        if not md5_hex or not url or not re.match("^/hatrac/.+:[^/]+$", url):
+            return
+        with self._lock:
+            self.md5_to_url.setdefault(md5_hex.lower(), url)
+
+    def lookup(self, md5_hex):
+        if not md5_hex:
+            return None
+        return self.md5_to_url.get(md5_hex.lower())
+
+    # return the existing url only if the object is still in the store with the same content
+    def lookup_verified(self, store, md5_hex):
+        url = self.lookup(md5_hex)
+        if not url:
+            return None
+        md = get_hatrac_metadata(store, url)
+        if md and md.get("content-md5") == hex_to_base64(md5_hex):
+            return url
+        with self._lock:
+            self.md5_to_url.pop(md5_hex.lower(), None)
+        return None
+
+    def save(self, index_file):
+        with open(index_file, "w") as f:
+            json.dump(self.md5_to_url, f)
+
+    def load(self, index_file):
+        with open(index_file) as f:
+            self.md5_to_url.update(json.load(f))
+        return self
+
+# ===================================================================================
+# -- namespace walk
+# a hatrac child is an object if its HEAD response carries a content-md5 or a versioned
+# content-location. Otherwise, it is treated as a namespace.
+def is_hatrac_object_metadata(md):
+    if not md:
+        return False
+    return "content-md5" in md.keys() or re.match("^.*/[^/]+:[^/]+$", md.get("content-location", "")) is not None
+
+# ----------------------------------------------------------
+# walk hatrac namespaces breadth-first. The namespaces of each level are listed concurrently
+# and their children are probed concurrently.
+# known_objects: a set of object paths whose metadata doesn't need to be fetched again
+# return: (list of namespace paths, { object_path: metadata or None if known })
+@traced("namespace_paths")
+def walk_hatrac_namespaces(store, namespace_paths, workers=None, known_objects=set(), ctx=None):
+    ctx = get_context(ctx, store)
+    workers = ctx.cfg.perf("hatrac_walk_workers", workers)
+    namespaces = []
+    objects = {}
+    level = [ ns.rstrip("/") for ns in namespace_paths ]
+
+    def list_children(ns):
+        try:
+            return request(store, "get", ns, headers={"Accept": "application/json"}, ctx=ctx).json()
+        except requests.HTTPError as e:
+            print("WARNING: can't list namespace %s: %s" % (ns, e))
+            return []
+
+    def probe(path):
+        if path in known_objects:
+            return (path, None)
+        return (path, get_hatrac_metadata(store, path))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            namespaces.extend(level)
+            children = []
+            for listing in executor.map(list_children, level):
+                children.extend([ c.rstrip("/") for c in listing ])
+            level = []
+            for path, md in executor.map(probe, children):
+                if path in known_objects or is_hatrac_object_metadata(md):
+                    objects[path] = md
+                else:
+                    level.append(path)
+            print("walk_hatrac_namespaces: %d namespaces, %d objects" % (len(namespaces), len(objects)))
+    return namespaces, objects
+
 # ===================================================================================
@@ -1,17 +1,20 @@
 #!/usr/bin/python
 
 import sys
+import os
 import json
-from deriva.core import ErmrestCatalog, AttrDict, get_credential, DEFAULT_CREDENTIAL_FILE, tag, urlquote, DerivaServer, get_credential, BaseCLI
-from deriva.core.ermrest_model import builtin_types, Schema, Table, Column, Key, ForeignKey
-from deriva.core import urlquote, urlunquote
-import argparse
+import pickle
+import hashlib
+import time
+from deriva.core import AttrDict, tag, urlquote, urlunquote, NotModified
+from deriva.core.ermrest_model import builtin_types, Schema, Table, Column, Key, Model
 import re
+import weakref
+import threading
 
-from .shared import tag2name
-
-# group id to group name mapping.
-ermrest_groups = {}
+from .shared import tag2name, request, get_context
+from .data import get_entities
+from .policy import check_model_policies
 
 # annotation tages configured at per-schema annotation script
 per_schema_annotation_tags = [
@@ -28,53 +31,377 @@ per_tag_annotation_tags = [
     tag["citation"],     
 ]
 
+# -- model snapshots, see get_catalog_model
+DEFAULT_MODEL_CACHE_DIR = os.path.expanduser("~/.deriva/atlas_d2k/models")
+
 TEXT_ARRAY_COLUMNS = [],
 MARKDOWN_COLUMNS = ["Notes"]
 INT4_COLUMNS = []
 
+# -- =================================================================================
+# -- persistent model snapshots
+#
+# LazySchemas holds the schema documents of a model and only builds a Schema (and digests its
+# foreign keys) when the schema is accessed. Referenced schemas are built as needed to
+# resolve the foreign keys.
+# NOTE: table.referenced_by only contains the foreign keys of schemas that have been built.
+# Call LazyModel.load_all() before relying on referenced_by.
+class LazySchemas(dict):
+    def __init__(self, model, schema_docs):
+        super().__init__()
+        self._model = model
+        self._docs = dict(schema_docs)
+        self._names = list(schema_docs.keys())
+
+    def _load(self, sname):
+        schema = Schema(self._model, sname, self._docs.pop(sname))
+        dict.__setitem__(self, sname, schema)
+        for table in schema.tables.values():
+            for fkey in list(table.foreign_keys):
+                try:
+                    fkey.digest_referenced_columns(self._model)
+                except KeyError:
+                    del table.foreign_keys[fkey.name]
+        return schema
+
+    def __missing__(self, sname):
+        if sname in self._docs:
+            return self._load(sname)
+        raise KeyError(sname)
+
+    def __setitem__(self, sname, schema):
+        self._docs.pop(sname, None)
+        if sname not in self._names:
+            self._names.append(sname)
+        dict.__setitem__(self, sname, schema)
+
+    def __delitem__(self, sname):
+        if sname in self._docs:
+            del self._docs[sname]
+        else:
+            dict.__delitem__(self, sname)
+        self._names.remove(sname)
+
+    def pop(self, sname, *default):
+        if sname not in self:
+            if default: return default[0]
+            raise KeyError(sname)
+        schema = self[sname]
+        del self[sname]
+        return schema
+
+    def __contains__(self, sname):
+        return sname in self._docs or dict.__contains__(self, sname)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, sname, default=None):
+        return self[sname] if sname in self else default
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return [ self[sname] for sname in self._names ]
+
+    def items(self):
+        return [ (sname, self[sname]) for sname in self._names ]
+
+# ----------------------------------------------------------------
+class LazyModel(Model):
+    def __init__(self, catalog, model_doc):
+        self._catalog = catalog
+        self._pseudo_fkeys = {}
+        self.acls = AttrDict(model_doc.get('acls', {}))
+        self.annotations = dict(model_doc.get('annotations', {}))
+        self.schemas = LazySchemas(self, model_doc.get('schemas', {}))
+
+    def load_all(self):
+        self.schemas.values()
+        return self
+
+# ----------------------------------------------------------------
+def get_model_snapshot_dir(catalog, cache_dir=DEFAULT_MODEL_CACHE_DIR):
+    return os.path.join(cache_dir, catalog._server, str(catalog.catalog_id))
+
+# ----------------------------------------------------------------
+# return the most recent snapshot saved for the catalog or None
+def load_latest_model_snapshot(snapshot_dir):
+    if not os.path.isdir(snapshot_dir):
+        return None
+    files = [ os.path.join(snapshot_dir, f) for f in os.listdir(snapshot_dir) if f.endswith(".pickle") ]
+    if not files:
+        return None
+    return load_model_snapshot(max(files, key=os.path.getmtime))
+
+# ----------------------------------------------------------------
+def load_model_snapshot(snapshot_file):
+    try:
+        with open(snapshot_file, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        print("WARNING: ignore unreadable model snapshot %s: %s" % (snapshot_file, e))
+        return None
+
+# ----------------------------------------------------------------
+# snapshot: {"snaptime": ..., "etag": ..., "doc": model_doc}. Only keep the max_snapshots most recent.
+def save_model_snapshot(snapshot_dir, snapshot, max_snapshots=3):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_file = os.path.join(snapshot_dir, "%s.pickle" % (snapshot["snaptime"]))
+    tmp_file = "%s.%d.tmp" % (snapshot_file, os.getpid())
+    with open(tmp_file, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)
+    files = sorted([ os.path.join(snapshot_dir, f) for f in os.listdir(snapshot_dir) if f.endswith(".pickle") ], key=os.path.getmtime)
+    for f in files[0:-max_snapshots]:
+        os.remove(f)
+    return snapshot_file
+
+# ----------------------------------------------------------------
+# Return the catalog model using a snapshot stored per host, catalog and snaptime.
+# - catalog bound to a snaptime (ErmrestSnapshot): load the snapshot without any request.
+# - offline=True: use the most recent snapshot without any request.
+# - otherwise: send a conditional GET /schema based on the etag of the most recent snapshot, so
+#   the model document is only downloaded when the model has changed.
+# With lazy=True, schemas are only deserialized when they are accessed (see LazyModel).
+def get_catalog_model(catalog, cache_dir=DEFAULT_MODEL_CACHE_DIR, lazy=True, offline=False, max_snapshots=3):
+    model_class = LazyModel if lazy else Model
+    snapshot_dir = get_model_snapshot_dir(catalog, cache_dir)
+    snaptime = getattr(catalog, "_snaptime", None)
+    if snaptime:
+        snapshot = load_model_snapshot(os.path.join(snapshot_dir, "%s.pickle" % (snaptime)))
+    else:
+        snapshot = load_latest_model_snapshot(snapshot_dir)
+    if snapshot and (snaptime or offline):
+        return model_class(catalog, snapshot["doc"])
+
+    # -- with raise_not_modified, deriva doesn't keep the empty 304 response as the cached
+    # /schema response, which would break later catalog.getCatalogModel() calls
+    headers = {}
+    if snapshot and snapshot.get("etag"):
+        headers["If-None-Match"] = snapshot["etag"]
+    try:
+        resp = request(catalog, "get", "/schema", headers=headers, raise_not_modified=True)
+    except NotModified:
+        return model_class(catalog, snapshot["doc"])
+
+    if not snaptime:
+        snaptime = request(catalog, "get", "/").json()["snaptime"]
+    snapshot = {"snaptime": snaptime, "etag": resp.headers.get("etag"), "doc": resp.json()}
+    save_model_snapshot(snapshot_dir, snapshot, max_snapshots)
+    return model_class(catalog, snapshot["doc"])
+
 # -- =================================================================================
 # -- model changes utilities
 # -- 
 # add table if not exist or update if exist
-def create_schema_if_not_exist(model, schema_name, schema_comment=None):
+def create_schema_if_not_exist(model, schema_name, schema_comment=None, changeset=None):
+    if changeset:
+        if not changeset.has_schema(schema_name):
+            changeset.create_schema(Schema.define(schema_name, schema_comment))
+        return
     if schema_name not in model.schemas:
         
         model.create_schema(Schema.define(schema_name, schema_comment))
+        invalidate_model_index(model)
         print('create schema %s' % (schema_name))
 
 # ----------------------------------------------------------------        
 # add table if not exist or update if exist
-def create_table_if_not_exist(model, schema_name, tdoc):
+def create_table_if_not_exist(model, schema_name, tdoc, changeset=None):
+    if changeset:
+        if not changeset.has_table(schema_name, tdoc["table_name"]):
+            changeset.create_table(schema_name, tdoc)
+        return
     schema = model.schemas[schema_name]
     if tdoc["table_name"] not in schema.tables:
         schema.create_table(tdoc)
+        invalidate_model_index(model)
         print('create table %s:%s' % (schema_name, tdoc["table_name"]))        
 
 # ----------------------------------------------------------------
-def drop_table_if_exist(model, schema_name, table_name):
+def drop_table_if_exist(model, schema_name, table_name, changeset=None):
     if schema_name not in model.schemas.keys():
         raise TypeError("ERROR: drop table: schema %s doesn't exist" % (schema_name))
 
     schema = model.schemas[schema_name]
-    if table_name in schema.tables.keys():
+    if table_name in schema.tables.keys() and changeset:
+        changeset.drop_table(schema_name, table_name)
+    elif table_name in schema.tables.keys():
         model.schemas[schema_name].tables[table_name].drop()
+        invalidate_model_index(model)
         print('Drop table %s:%s' % (schema_name, table_name))
     else:
         print("ERROR: drop table: table %s:%s doesn't exist" % (schema_name, table_name))
 
 # ----------------------------------------------------------------
 # Check that schema and table exist.. 
-def drop_column_if_exist(model, schema_name, table_name, column_name):
+def drop_column_if_exist(model, schema_name, table_name, column_name, changeset=None):
     if schema_name not in model.schemas.keys() or table_name not in model.schemas[schema_name].tables.keys():
         raise TypeError("ERROR: either schema %s or table %s doesn't exist" % (schema_name, table_name))
     
     table = model.schemas[schema_name].tables[table_name]
-    if column_name in table.columns.elements:
+    if column_name in table.columns.elements and changeset:
+        changeset.drop_column(schema_name, table_name, column_name)
+    elif column_name in table.columns.elements:
         table.columns[column_name].drop()
+        invalidate_model_index(model)
         print('Drop column %s:%s:%s' % (schema_name, table_name, column_name))
     else:
         print("ERROR: drop column: column %s:%s:%s doesn't exist" % (schema_name, table_name, column_name))
         
+# ----------------------------------------------------------------
+# ModelChangeSet collects model changes and submits them with the fewest possible requests:
+#   - column drops, then table drops (referring tables before referenced tables). ERMrest has
+#     no bulk delete, so each drop is one DELETE request.
+#   - one bulk POST /schema with all new schemas (including their new tables) and new tables of
+#     existing schemas, ordered so that referenced tables are created first. ERMrest applies the
+#     whole list in one transaction.
+# e.g.
+#   changes = ModelChangeSet(model)
+#   create_schema_if_not_exist(model, "Vocab", changeset=changes)
+#   create_table_if_not_exist(model, "Vocab", tdoc, changeset=changes)
+#   changes.submit(dry_run=args.dry_run)
+class ModelChangeSet():
+    model = None
+
+    def __init__(self, model):
+        self.model = model
+        self.schema_defs = {}       # sname -> schema doc
+        self.table_defs = {}        # (sname, tname) -> table doc
+        self.table_drops = []       # (sname, tname)
+        self.column_drops = []      # (sname, tname, cname)
+
+    def has_schema(self, schema_name):
+        return schema_name in self.model.schemas or schema_name in self.schema_defs
+
+    def has_table(self, schema_name, table_name):
+        if (schema_name, table_name) in self.table_defs:
+            return True
+        return schema_name in self.model.schemas and table_name in self.model.schemas[schema_name].tables \
+            and (schema_name, table_name) not in self.table_drops
+
+    def create_schema(self, schema_def):
+        self.schema_defs[schema_def["schema_name"]] = schema_def
+
+    def create_table(self, schema_name, table_def):
+        if not self.has_schema(schema_name):
+            raise TypeError("ERROR: create table: schema %s doesn't exist" % (schema_name))
+        self.table_defs[(schema_name, table_def["table_name"])] = table_def
+
+    def drop_table(self, schema_name, table_name):
+        if (schema_name, table_name) not in self.table_drops:
+            self.table_drops.append((schema_name, table_name))
+
+    def drop_column(self, schema_name, table_name, column_name):
+        if (schema_name, table_name, column_name) not in self.column_drops:
+            self.column_drops.append((schema_name, table_name, column_name))
+
+    def is_empty(self):
+        return not (self.schema_defs or self.table_defs or self.table_drops or self.column_drops)
+
+    # order items so that the tables referenced by an item are created before it
+    # items: [ (provided_tables, referenced_tables, payload) ]
+    @staticmethod
+    def sort_by_dependency(items):
+        ordered = []
+        pending = list(items)
+        while pending:
+            provided_later = set()
+            for provided, referenced, payload in pending:
+                provided_later.update(provided)
+            ready = [ item for item in pending if not ((item[1] - item[0]) & provided_later) ]
+            if not ready:
+                # cycle: keep the remaining order and let the server sort it out
+                ready = pending
+            ordered.extend([ item[2] for item in ready ])
+            pending = [ item for item in pending if item not in ready ]
+        return ordered
+
+    @staticmethod
+    def referenced_tables(table_def):
+        referenced = set()
+        for fkey_def in table_def.get("foreign_keys", []):
+            for c in fkey_def.get("referenced_columns", []):
+                referenced.add((c["schema_name"], c["table_name"]))
+        return referenced
+
+    # return the list of requests in the order they will be submitted
+    def plan(self):
+        requests = []
+        for sname, tname, cname in self.column_drops:
+            if (sname, tname) in self.table_drops: continue
+            requests.append({"method": "DELETE", "path": "/schema/%s/table/%s/column/%s" % (urlquote(sname), urlquote(tname), urlquote(cname))})
+
+        # -- drop referring tables first
+        drop_items = []
+        for sname, tname in self.table_drops:
+            table = self.model.schemas[sname].tables[tname]
+            referring = { (fk.table.schema.name, fk.table.name) for fk in table.referenced_by } - {(sname, tname)}
+            drop_items.append(({(sname, tname)}, referring, (sname, tname)))
+        for sname, tname in self.sort_by_dependency(drop_items):
+            requests.append({"method": "DELETE", "path": "/schema/%s/table/%s" % (urlquote(sname), urlquote(tname))})
+
+        # -- nest new tables of new schemas in the schema doc
+        create_items = []
+        for sname, schema_def in self.schema_defs.items():
+            doc = dict(schema_def)
+            tables = { tname: tdef for (s, tname), tdef in self.table_defs.items() if s == sname }
+            doc["tables"] = dict(doc.get("tables", {}), **tables)
+            provided = { (sname, tname) for tname in doc["tables"] }
+            referenced = set().union(*[ self.referenced_tables(tdef) for tdef in doc["tables"].values() ])
+            create_items.append((provided, referenced, doc))
+        for (sname, tname), table_def in self.table_defs.items():
+            if sname in self.schema_defs: continue
+            doc = dict(table_def, schema_name=sname)
+            create_items.append(({(sname, tname)}, self.referenced_tables(table_def), doc))
+        if create_items:
+            requests.append({"method": "POST", "path": "/schema", "json": self.sort_by_dependency(create_items)})
+        return requests
+
+    # submit the planned requests and update the local model. With dry_run, only print the plan.
+    def submit(self, dry_run=False):
+        requests = self.plan()
+        for req in requests:
+            if req["method"] == "POST":
+                print("%s %s: %s" % (req["method"], req["path"], ", ".join([ "%s%s" % (d["schema_name"], ":"+d["table_name"] if "table_name" in d else "") for d in req["json"] ])))
+            else:
+                print("%s %s" % (req["method"], req["path"]))
+        if dry_run:
+            return requests
+
+        catalog = self.model.catalog
+        for req in requests:
+            if req["method"] == "DELETE":
+                # -- sent through request() like the POST, then applied to the local model as Column.drop()/Table.drop() would
+                resp = request(catalog, "delete", req["path"])
+                resp.raise_for_status()
+                names = [ urlunquote(p) for p in re.match("^/schema/([^/]+)/table/([^/]+)(?:/column/([^/]+))?$", req["path"]).groups() if p is not None ]
+                table = self.model.schemas[names[0]].tables[names[1]]
+                if len(names) == 3:
+                    del table.column_definitions[names[2]]
+                else:
+                    del table.schema.tables[table.name]
+                    for fkey in table.foreign_keys:
+                        fkey._cleanup()
+            elif req["method"] == "POST":
+                resp = request(catalog, "post", req["path"], json=req["json"])
+                resp.raise_for_status()
+                for doc in resp.json():
+                    if "table_name" in doc:
+                        schema = self.model.schemas[doc["schema_name"]]
+                        schema.tables[doc["table_name"]] = Table(schema, doc["table_name"], doc)
+                    else:
+                        self.model.schemas[doc["schema_name"]] = Schema(self.model, doc["schema_name"], doc)
+                self.model.digest_fkeys()
+        invalidate_model_index(self.model)
+        self.schema_defs, self.table_defs, self.table_drops, self.column_drops = {}, {}, [], []
+        return requests
+
 # -------------------------------------------------------
 def create_column_defs(cname_list):
     column_defs = []
@@ -206,29 +533,101 @@ def create_vocabulary_tdoc(schema_name, table_name, table_comment, other_cnames)
 # this section contains the helper functions for print model extras
 #
 #
-#ermrest_groups["https://auth.globus.org/6068dc4b-73ee-4143-b606-29c6780f582f"] = 'rbkcc',
-def set_ermrest_groups(catalog):
-    global ermrest_groups
-    resp = catalog.get("/attribute/public:ERMrest_Group/ID,Display_Name")
-    rows = resp.json()
-    for row in rows:
-        ermrest_groups[row["ID"]] = row["Display_Name"]
-
-    resp = catalog.get("/attribute/public:ERMrest_Client/ID,Display_Name,Email")
-    rows = resp.json()
-    for row in rows:
-        ermrest_groups[row["ID"]] = row["Email"]
+# ErmrestGroupResolver maps group and client IDs of a catalog to names. The ERMrest_Group and
+# ERMrest_Client tables are fetched in pages and cached on disk per host and catalog. Within
+# ttl seconds the cache is used as is. After that, only rows modified after the cached RMT are
+# fetched. Rows deleted from the catalog are only dropped by refresh(full=True).
+#
+DEFAULT_GROUP_CACHE_DIR = os.path.expanduser("~/.deriva/atlas_d2k/groups")
+DEFAULT_GROUP_CACHE_TTL = 24 * 3600
+
+class ErmrestGroupResolver():
+    # table name -> column mapped to the ID
+    group_tables = {"ERMrest_Group": "Display_Name", "ERMrest_Client": "Email"}
+
+    def __init__(self, catalog, cache_dir=DEFAULT_GROUP_CACHE_DIR, ttl=DEFAULT_GROUP_CACHE_TTL):
+        self.catalog = catalog
+        self.ttl = ttl
+        self.cache_file = os.path.join(cache_dir, "%s_%s.json" % (catalog._server, catalog.catalog_id))
+        self.groups = {}
+        self.max_rmt = {}
+        self.fetched = 0
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file) as f:
+                    cache = json.load(f)
+                self.groups, self.max_rmt, self.fetched = cache["groups"], cache["max_rmt"], cache["fetched"]
+            except (OSError, ValueError, KeyError) as e:
+                print("WARNING: ignore unreadable group cache %s: %s" % (self.cache_file, e))
+        if time.time() - self.fetched > self.ttl:
+            self.refresh()
+        return self
+
+    # the new mappings are built aside and swapped in, so readers of self.groups in other
+    # threads never see a dict being modified
+    def refresh(self, full=False):
+        with self.lock:
+            groups, max_rmt = ({}, {}) if full else (dict(self.groups), dict(self.max_rmt))
+            for table_name, name_column in self.group_tables.items():
+                constraints = None
+                if max_rmt.get(table_name):
+                    constraints = "RMT::gt::%s" % (urlquote(max_rmt[table_name]))
+                rows = get_entities(self.catalog, "public", table_name, constraints=constraints, keys=["RID"],
+                                    attr_list=["ID", name_column, "RMT"], sort=["RMT", "RID"])
+                for row in rows:
+                    groups[row["ID"]] = row[name_column]
+                if rows:
+                    max_rmt[table_name] = rows[-1]["RMT"]
+            self.groups, self.max_rmt = groups, max_rmt
+            self.fetched = time.time()
+            self.save()
+        return self
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump({"groups": self.groups, "max_rmt": self.max_rmt, "fetched": self.fetched}, f)
+            os.replace(tmp_file, self.cache_file)
+
+    def resolve(self, group_id):
+        return self.groups.get(group_id, group_id)
+
+# ----------------------------------------------------------
+# resolvers are cached in the context of the catalog
+def get_group_resolver(catalog, ctx=None):
+    ctx = get_context(ctx, catalog)
+    key = (catalog._server, catalog.catalog_id)
+    return ctx.get_cached("group_resolvers", key, lambda: ErmrestGroupResolver(catalog))
+
+# ----------------------------------------------------------
+# group id to group name mapping of the context, used by humanize_acls when groups is not given.
+# kept for backward compatibility. Use get_group_resolver(catalog).groups instead.
+#get_ermrest_groups()["https://auth.globus.org/6068dc4b-73ee-4143-b606-29c6780f582f"] = 'rbkcc',
+def get_ermrest_groups(ctx=None):
+    return get_context(ctx).cache("ermrest_groups")
+
+def set_ermrest_groups(catalog, ctx=None):
+    ctx = get_context(ctx, catalog)
+    get_ermrest_groups(ctx).update(get_group_resolver(catalog, ctx).groups)
 
 # ----------------------------------------------------------
 # replace group id with group name based on the value stored in ermrest
 #
-def humanize_acls(acls):
+def humanize_acls(acls, groups=None, ctx=None):
+    if groups is None:
+        groups = get_ermrest_groups(ctx)
     str = {}
-    for role, groups in acls.items():
+    for role, acl in acls.items():
         hgroups = []
-        for g in groups: 
-            if g in ermrest_groups.keys():
-                hgroups.append(ermrest_groups[g])
+        for g in acl: 
+            if g in groups.keys():
+                hgroups.append(groups[g])
             else: 
                 hgroups.append(g)
         str[role] = hgroups
@@ -237,7 +636,9 @@ def humanize_acls(acls):
 # ----------------------------------------------------------
 # replace group id with group name based on the value stored in ermrest
 #
-def humanize_acl_bindings(acl_bindings):
+def humanize_acl_bindings(acl_bindings, groups=None, ctx=None):
+    if groups is None:
+        groups = get_ermrest_groups(ctx)
     #print("---%s---" % (acl_bindings))
     str = acl_bindings.copy()
     for name, acl_binding in str.items():
@@ -245,11 +646,12 @@ def humanize_acl_bindings(acl_bindings):
             continue
         scope_acl = []
         for g in acl_binding["scope_acl"]:
-            if g in ermrest_groups.keys():
-                scope_acl.append(ermrest_groups[g])
+            if g in groups.keys():
+                scope_acl.append(groups[g])
             else: 
                 scope_acl.append(g)
-        acl_binding["scope_acl"] = scope_acl
+        # copy the binding so the model is not modified
+        str[name] = dict(acl_binding, scope_acl=scope_acl)
         #print("set acl_bindings [%s][%s] to %s" % (name, "scope_acl", scope_acl))
     return str
 
@@ -261,25 +663,24 @@ def print_table_model_extras(model, schema_name, table_name, annotations=True, a
     default_fkey_acls = {"insert": ["*"], "update": ["*"]}    
     table = model.schemas[schema_name].tables[table_name]
     
-    if not ermrest_groups:
-        set_ermrest_groups(model.catalog)        
+    groups = get_group_resolver(model.catalog).groups
     
     if annotations and table.annotations: print("  t-a   %s annotations: %s" % (table.name, json.dumps(table.annotations, indent=2)))
-    if acls and table.acls: print("  t-acl %s: %s" % (table.name, humanize_acls(table.acls)))
-    if acl_bindings and table.acl_bindings: print("  t-ab  %s: %s" % (table.name, humanize_acl_bindings(table.acl_bindings)))
+    if acls and table.acls: print("  t-acl %s: %s" % (table.name, humanize_acls(table.acls, groups)))
+    if acl_bindings and table.acl_bindings: print("  t-ab  %s: %s" % (table.name, humanize_acl_bindings(table.acl_bindings, groups)))
     for cname in table.columns.elements:
         column = table.columns[cname]
         if annotations and column.annotations: print("    c-a %s.%s: %s" % (table.name, column.name, json.dumps(column.annotations, indent=2)))
-        if acls and column.acls: print("    c-acl: %s.%s: %s" % (table.name, column.name, humanize_acls(column.acls)))
-        if acl_bindings and column.acl_bindings: print("    c-ab  %s.%s: %s" % (table.name, column.name, humanize_acl_bindings(column.acl_bindings)))
+        if acls and column.acls: print("    c-acl: %s.%s: %s" % (table.name, column.name, humanize_acls(column.acls, groups)))
+        if acl_bindings and column.acl_bindings: print("    c-ab  %s.%s: %s" % (table.name, column.name, humanize_acl_bindings(column.acl_bindings, groups)))
     for key in table.keys:
         if annotations and key.annotations: print("    k-a    %s: %s" % (key.constraint_name, json.dumps(key.annotations, indent=2)))
     for fkey in table.foreign_keys:
         if annotations and fkey.annotations: print("    fk-a     %s: %s" % (fkey.constraint_name, json.dumps(fkey.annotations, indent=2)))
         if acls and fkey.acls:
             if (exclude_default_fkey and fkey.acls != default_fkey_acls) or (exclude_default_fkey == False):
-                print("    fk-acl  %s: %s" % (fkey.constraint_name, humanize_acls(fkey.acls)))
-        if acl_bindings and fkey.acl_bindings: print("    fk-ab   %s: %s" % (fkey.constraint_name, humanize_acl_bindings(fkey.acl_bindings)))
+                print("    fk-acl  %s: %s" % (fkey.constraint_name, humanize_acls(fkey.acls, groups)))
+        if acl_bindings and fkey.acl_bindings: print("    fk-ab   %s: %s" % (fkey.constraint_name, humanize_acl_bindings(fkey.acl_bindings, groups)))
 
 
 # ----------------------------------------------------------
@@ -290,22 +691,20 @@ def print_schema_model_extras(model, schema_name, annotations=True, acls=True, a
     default_fkey_acls = {"insert": ["*"], "update": ["*"]}    
     schema = model.schemas[schema_name]
 
-    if not ermrest_groups:
-        set_ermrest_groups(model.catalog)        
+    groups = get_group_resolver(model.catalog).groups
     
     print("--------- %s ---------------" % (schema_name))
     if annotations and schema.annotations: print("s-a    s: %s: %s" % (schema_name, schema.annotations))
-    if acls and schema.acls: print("s-acl  %s : %s" % (schema_name, humanize_acls(schema.acls)))
+    if acls and schema.acls: print("s-acl  %s : %s" % (schema_name, humanize_acls(schema.acls, groups)))
     for table in model.schemas[schema_name].tables.values():
         print_table_model_extras(model, schema_name, table.name, annotations, acls, acl_bindings, exclude_default_fkey)
     
 # ----------------------------------------------------------            
 def print_catalog_model_extras(model, annotations=True, acls=True, acl_bindings=True, exclude_default_fkey=True):
-    if not ermrest_groups:
-        set_ermrest_groups(model.catalog)        
+    groups = get_group_resolver(model.catalog).groups
     
     print("=========== catalog acls ============")
-    print(humanize_acls(model.acls))
+    print(humanize_acls(model.acls, groups))
     for schema_name in model.schemas:
         print_schema_model_extras(model, schema_name, annotations, acls, acl_bindings, exclude_default_fkey)
 
@@ -315,82 +714,126 @@ def print_catalog_model_extras(model, annotations=True, acls=True, acl_bindings=
 
 # -----------------------------------------------------------
 # throw an exception of CREATE or WRITE are in acls
-def check_acl_types(acls, name):
+def check_acl_types(acls, name, groups=None):
     if not acls:
         return
     if "create" in acls.keys() or "write" in acls.keys(): 
-        raise TypeError("ERROR: create/write are now allowed in acls: %s -> %s" % (name, humanize_acls(acls)))
+        raise TypeError("ERROR: create/write are now allowed in acls: %s -> %s" % (name, humanize_acls(acls, groups)))
 
 # -----------------------------------------------------------    
-def check_model_acl_types(model):
-    if not ermrest_groups:
-        set_ermrest_groups(model.catalog)        
-    
-    check_acl_types(model.acls, "catalog")    
-    for schema_name in model.schemas:
-        schema = model.schemas[schema_name]
-        check_acl_types(schema.acls, schema_name)
-        for table in schema.tables.values():
-            check_acl_types(table.acls, "%s.%s" % (schema_name, table.name))
-            for cname in table.columns.elements:
-                column = table.columns[cname]
-                check_acl_types(column.acls, "%s.%s.%s" % (schema_name, table.name, cname))
-            for fkey in table.foreign_keys:
-                check_acl_types(fkey.acls, "%s.%s.%s" % (schema_name, table.name, fkey.constraint_name))
+# throw an exception listing all elements with CREATE or WRITE in their acls
+def check_model_acl_types(model, workers=1):
+    groups = get_group_resolver(model.catalog).groups
+    violations = check_model_policies(model, ["forbidden_acl_types"], workers=workers)
+    if violations:
+        messages = []
+        for v in violations:
+            message = "%s acl is not allowed: %s" % (v["acl_type"], humanize_acls({v["acl_type"]: v["acl"]}, groups)[v["acl_type"]])
+            messages.append("%s -> %s" % (".".join([ str(n) for n in v["node"][1:] ]) or "catalog", message))
+        raise TypeError("ERROR: create/write are now allowed in acls:\n%s" % ("\n".join(messages)))
     
         
 # =================================================================================
 # helper functions to iternate over the model and return a set of tables, columns
 # according to the specified parameters
 #
+# ModelIndex maps names to model objects and caches compiled patterns and their matches, so
+# repeated get_schemas/get_tables/get_columns calls do not traverse the model again.
+# Tables and columns of a schema are only indexed when the schema is first queried.
+# The index is built once per model (see get_model_index). Call invalidate_model_index after
+# changing the model structure.
+# The index is kept on the model itself, not in a map keyed by the model: the cached tables and
+# columns reference their model, so a map entry would keep every indexed model alive.
+class ModelIndex():
+    def __init__(self, model):
+        self._model = weakref.ref(model)
+        self.schema_names = list(model.schemas.keys())
+        self._tables = {}         # sname -> { tname: table }
+        self._columns = {}        # (sname, tname) -> { cname: column }
+        self._patterns = {}       # pattern -> compiled pattern
+        self._matches = {}        # (pattern, scope) -> [ names ]
+
+    def compile(self, pattern):
+        if pattern not in self._patterns:
+            self._patterns[pattern] = re.compile(pattern)
+        return self._patterns[pattern]
+
+    def _match(self, pattern, scope, names):
+        key = (pattern, scope)
+        if key not in self._matches:
+            regex = self.compile(pattern)
+            self._matches[key] = [ n for n in names if regex.search(n) ]
+        return self._matches[key]
+
+    @property
+    def model(self):
+        return self._model()
+
+    def schema(self, sname):
+        return self.model.schemas[sname]
+
+    def tables(self, sname):
+        if sname not in self._tables:
+            self._tables[sname] = dict(self.model.schemas[sname].tables.items())
+        return self._tables[sname]
+
+    def columns(self, table):
+        key = (table.schema.name, table.name)
+        if key not in self._columns:
+            self._columns[key] = { c.name: c for c in table.columns }
+        return self._columns[key]
+
+    def match_schemas(self, pattern):
+        return self._match(pattern, None, self.schema_names)
+
+    def match_tables(self, sname, pattern):
+        return [ self.tables(sname)[tname] for tname in self._match(pattern, (sname,), self.tables(sname).keys()) ]
+
+    def match_columns(self, table, pattern):
+        columns = self.columns(table)
+        return [ columns[cname] for cname in self._match(pattern, (table.schema.name, table.name), columns.keys()) ]
+
+# ----------------------------
+def get_model_index(model):
+    index = getattr(model, "_atlas_d2k_index", None)
+    if index is None:
+        index = ModelIndex(model)
+        model._atlas_d2k_index = index
+    return index
+
+def invalidate_model_index(model):
+    model._atlas_d2k_index = None
+
 # ------------------------------------------------------------------------------------------------    
 def get_schemas(model, schema_pattern=None, schema_names=[]):
+    index = get_model_index(model)
     schemas = set()
-    for sname, schema in model.schemas.items():
-        if schema_pattern and re.match(sname, schema_pattern):
-            schemas.add(schema)
+    if schema_pattern:
+        for sname in index.match_schemas(schema_pattern):
+            schemas.add(index.schema(sname))
     for sname in schema_names:
-        schemas.add(model.schemas[sname])
+        schemas.add(index.schema(sname))
     return schemas
 
 # ----------------------------
 # error if schema doesn't exist.
 # ignore tables that do not exist. 
 def get_tables(model, schema_pattern=None, schema_names=[], table_pattern=None, table_names=[], exclude_schemas=[]):
+    index = get_model_index(model)
     tables = set()
-    sname_list = schema_names
-    tname_list = table_names
-    for sname, schema in model.schemas.items():
-        if schema_pattern and re.search(schema_pattern, sname):        
-            for tname, table in schema.tables.items():
-                if table_pattern and re.search(table_pattern, tname):
-                    tables.add(table)
-                    #print("t: add %s.%s" % (sname, tname))
-            for tname in tname_list:
-                if tname in schema.tables.keys():
-                    table = schemas.tables[tname]
-                    tables.add(table)
-                    #print("t: add %s.%s" % (sname, table.name))                        
-                else:
-                    # print("tname: %s.%s does not exist" % (sname, tname))
-                    pass
-
+    snames = list(index.match_schemas(schema_pattern)) if schema_pattern else []
     # assume schema exists
-    for sname in sname_list:
-        schema = model.schemas[sname]
-        for tname, table in schema.tables.items():
-            if table_pattern and re.search(table_pattern, tname):
-                tables.add(table)
-                #print("t: add %s.%s" % (table.schema.name, tname))                
-        else:
-            for tname in tname_list:
-                if tname in schema.tables.keys():
-                    table = schema.tables[tname]
-                    tables.add(table)
-                    #print("t: add %s.%s" % (sname, table.name))                    
-                else:
-                    # print("tname: %s.%s does not exist" % (sname, tname))
-                    pass
+    for sname in schema_names:
+        index.schema(sname)
+        snames.append(sname)
+
+    for sname in snames:
+        if table_pattern:
+            tables.update(index.match_tables(sname, table_pattern))
+        schema_tables = index.tables(sname)
+        for tname in table_names:
+            if tname in schema_tables:
+                tables.add(schema_tables[tname])
     return tables
 
 # ----------------------------    
@@ -399,13 +842,13 @@ def get_columns_helper(table, column_pattern, column_names=[], exclude_schemas=[
     # no need to set columns that are in schema or tables that are not in model
     if table.schema in exclude_schemas or table in exclude_tables:
         return columns
-    for cname in table.columns.elements:
-        column = table.columns[cname]
-        if column_pattern and re.search(column_pattern, cname):
-            columns.add(column)
+    index = get_model_index(table.schema.model)
+    if column_pattern:
+        columns.update(index.match_columns(table, column_pattern))
+    table_columns = index.columns(table)
     for cname in column_names:
-        if cname in table.columns.elements:
-            columns.add(table.columns[cname])
+        if cname in table_columns:
+            columns.add(table_columns[cname])
         else:
             #print("cname: %s.%s.%s does not exist" % (table.schema.name, table.name, cname))
             pass
@@ -415,23 +858,115 @@ def get_columns_helper(table, column_pattern, column_names=[], exclude_schemas=[
 # ----------------------------    
 def get_columns(model, schema_pattern=None, schema_names=[], table_pattern=None, table_names=[], column_pattern=None, column_names=[], exclude_schemas=[], exclude_tables=[]):
     columns = set()
-    for sname, schema in model.schemas.items():
-        if schema_pattern and re.search(schema_pattern, sname):
-            for tname, table in schema.tables.items():
-                if table_pattern and re.search(table_pattern, tname):
-                    columns.update(get_columns_helper(table, column_pattern, column_names, exclude_schemas, exclude_tables))
-            for tname in table_names:
-                columns.update(get_columns_helper(schema.tables[tname], column_pattern, column_names, exclude_schemas, exclude_tables))
+    for table in get_tables(model, schema_pattern, schema_names, table_pattern, table_names):
+        columns.update(get_columns_helper(table, column_pattern, column_names, exclude_schemas, exclude_tables))
+    return columns            
+
+# ----------------------------
+# return a list of asset columns based on the asset annotation e.g.
+#   {"schema": "RNASeq", "table": "File", "url": "URI", "md5": "MD5", "bytes": "Byte_Count", "filename": "File_Name"}
+# md5, bytes, and filename are None if not specified in the annotation.
+def get_asset_columns(model):
+    asset_columns = []
+    for schema in model.schemas.values():
+        for table in schema.tables.values():
+            for column in table.columns:
+                asset = column.annotations.get(tag["asset"])
+                if asset is None: continue
+                asset_columns.append({
+                    "schema": schema.name,
+                    "table": table.name,
+                    "url": column.name,
+                    "md5": asset.get("md5") if isinstance(asset.get("md5"), str) else None,
+                    "bytes": asset.get("byte_count_column"),
+                    "filename": asset.get("filename_column"),
+                })
+    return asset_columns
 
+# -- ==========================================================================
+# -- model traversal
+#
+# iterate over all model elements. Each element is identified by a key that is independent of
+# the model instance, so elements of two models (e.g. desired vs existing) can be aligned:
+#   ("catalog",), ("schema", sname), ("table", sname, tname), ("column", sname, tname, cname),
+#   ("key", sname, tname, constraint_sname, constraint_name), ("fkey", sname, tname, constraint_sname, constraint_name)
+def iter_model_nodes(model, schema_names=None):
+    if schema_names is None:
+        yield ("catalog",), model
+        schema_names = model.schemas.keys()
     for sname in schema_names:
         schema = model.schemas[sname]
+        yield ("schema", sname), schema
         for tname, table in schema.tables.items():
-            if table_pattern and re.search(table_pattern, tname):
-                columns.update(get_columns_helper(table, column_pattern, column_names, exclude_schemas, exclude_tables))
-        for tname in table_names:
-            columns.update(get_columns_helper(schema.tables[tname], column_pattern, column_names, exclude_schemas, exclude_tables))
+            yield ("table", sname, tname), table
+            for column in table.columns:
+                yield ("column", sname, tname, column.name), column
+            for key in table.keys:
+                yield ("key", sname, tname, key.constraint_schema.name if key.constraint_schema else None, key.constraint_name), key
+            for fkey in table.foreign_keys:
+                yield ("fkey", sname, tname, fkey.constraint_schema.name if fkey.constraint_schema else None, fkey.constraint_name), fkey
 
-    return columns            
+# ----------------------------------------------------------
+# ermrest path of the annotation resource of a model element
+def annotation_uri_path(node_key, node):
+    if node_key[0] == "catalog":
+        return "/annotation"
+    return "%s/annotation" % (node.uri_path)
+
+# ----------------------------------------------------------
+# structural part of an element document, without annotations, acls, acl_bindings, and children
+def node_structure(node_key, node):
+    if node_key[0] in ["catalog", "schema"]:
+        return {}
+    if node_key[0] == "table":
+        return {"kind": node.kind}
+    doc = dict(node.prejson())
+    for k in ["annotations", "acls", "acl_bindings", "comment", "names"]:
+        doc.pop(k, None)
+    return doc
+
+# ----------------------------------------------------------
+# compare two models element by element (aligned by name) and return a list of differences:
+#   {"node": node_key, "change": "added"|"removed"|"changed", "aspect": ..., "left": ..., "right": ...}
+# aspect is one of structure, comment, annotations (per tag), acls, acl_bindings.
+# "added" means the element only exists in the right model.
+def diff_models(left, right, schema_names=None, aspects=["structure", "comment", "annotations", "acls", "acl_bindings"]):
+    if schema_names is None:
+        left_nodes = dict(iter_model_nodes(left))
+        right_nodes = dict(iter_model_nodes(right))
+    else:
+        left_nodes = dict(iter_model_nodes(left, [ s for s in schema_names if s in left.schemas ]))
+        right_nodes = dict(iter_model_nodes(right, [ s for s in schema_names if s in right.schemas ]))
+    diffs = []
+    for node_key, lnode in left_nodes.items():
+        if node_key not in right_nodes:
+            diffs.append({"node": list(node_key), "change": "removed", "aspect": "structure"})
+            continue
+        rnode = right_nodes[node_key]
+        if "structure" in aspects:
+            lstruct, rstruct = node_structure(node_key, lnode), node_structure(node_key, rnode)
+            if lstruct != rstruct:
+                diffs.append({"node": list(node_key), "change": "changed", "aspect": "structure",
+                              "left": { k: v for k, v in lstruct.items() if rstruct.get(k) != v },
+                              "right": { k: v for k, v in rstruct.items() if lstruct.get(k) != v }})
+        if "comment" in aspects and getattr(lnode, "comment", None) != getattr(rnode, "comment", None):
+            diffs.append({"node": list(node_key), "change": "changed", "aspect": "comment", "left": lnode.comment, "right": rnode.comment})
+        if "annotations" in aspects:
+            for t in sorted(set(lnode.annotations.keys()) | set(rnode.annotations.keys())):
+                if lnode.annotations.get(t, None) != rnode.annotations.get(t, None) or (t in lnode.annotations) != (t in rnode.annotations):
+                    diffs.append({"node": list(node_key), "change": "changed", "aspect": "annotations", "tag": t,
+                                  "left": lnode.annotations.get(t), "right": rnode.annotations.get(t)})
+        for aspect in ["acls", "acl_bindings"]:
+            if aspect not in aspects or not hasattr(lnode, aspect): continue
+            lvalue, rvalue = dict(getattr(lnode, aspect)), dict(getattr(rnode, aspect))
+            if lvalue != rvalue:
+                diffs.append({"node": list(node_key), "change": "changed", "aspect": aspect,
+                              "left": { k: v for k, v in lvalue.items() if rvalue.get(k) != v },
+                              "right": { k: v for k, v in rvalue.items() if lvalue.get(k) != v }})
+    for node_key in right_nodes.keys():
+        if node_key not in left_nodes:
+            diffs.append({"node": list(node_key), "change": "added", "aspect": "structure"})
+    return diffs
 
 # -- ==========================================================================
 # -- annotation related utility functions
@@ -475,89 +1010,251 @@ def add_fkey_source_definitions(table, from_cname, to_tname, fkey_source_name):
 
     print(table.source_definitions)
 
+# -- ------------------------------------------------------------------------------------
+# annotation code generation. The generated functions set the per-schema annotation tags of a
+# schema or a table (including its columns and foreign keys) to their current values.
+ANNOTATION_CODEGEN_VERSION = 1
+ANNOTATION_MANIFEST_FILE = "annotation_manifest.json"
+
+def annotation_function_name(schema_name, table_name=None):
+    name = schema_name if table_name is None else "%s_%s" % (schema_name, table_name)
+    return "update_%s" % (re.sub("[^0-9A-Za-z_]", "_", name))
+
+# -- ------------------------------------------------------------------------------------
+def annotation_code_lines(target, annotations):
+    lines = []
+    for key, annotation in annotations.items():
+        if key not in tag2name.keys():
+            print("ERROR: %s -> %s" % (key, json.dumps(annotation, indent=4)))
+            continue
+        if key not in per_schema_annotation_tags: continue
+        lines.append('    # ----------------------------')
+        lines.append('    %s.annotations[tag["%s"]] = %s' % (target, tag2name[key], json.dumps(annotation, indent=4).replace("\n", "\n    ")))
+        lines.append('')
+    return lines
+
+# -- ------------------------------------------------------------------------------------
+# per-schema annotation content of a schema or a table (with its columns and fkeys)
+def schema_annotation_content(schema):
+    return { k: v for k, v in schema.annotations.items() if k in per_schema_annotation_tags }
+
+def table_annotation_content(table):
+    content = {
+        "table": { k: v for k, v in table.annotations.items() if k in per_schema_annotation_tags },
+        "columns": {},
+        "fkeys": {},
+    }
+    for column in table.columns:
+        if column.name in ["RID", "RCT", "RCB", "RMT", "RMB"]: continue
+        annotations = { k: v for k, v in column.annotations.items() if k in per_schema_annotation_tags }
+        if annotations: content["columns"][column.name] = annotations
+    for fkey in table.foreign_keys:
+        annotations = { k: v for k, v in fkey.annotations.items() if k in per_schema_annotation_tags }
+        if annotations: content["fkeys"][fkey.constraint_name] = annotations
+    return content
+
+def annotation_fingerprint(content):
+    return hashlib.sha256(json.dumps([ANNOTATION_CODEGEN_VERSION, content], sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+# -- ------------------------------------------------------------------------------------
+# return the code of update_<schema>(model), or None if the schema has no annotation to set
+def schema_annotation_code(schema):
+    lines = annotation_code_lines("schema", schema.annotations)
+    if not lines: return None
+    return "\n".join([
+        "def %s(model):" % (annotation_function_name(schema.name)),
+        '    schema = model.schemas["%s"]' % (schema.name),
+    ] + lines) + "\n"
+
+# -- ------------------------------------------------------------------------------------
+# return the code of update_<schema>_<table>(model), or None if the table has no annotation to set
+def table_annotation_code(table):
+    lines = annotation_code_lines('schema.tables["%s"]' % (table.name), table.annotations)
+    for column in table.columns:
+        if column.name in ["RID", "RCT", "RCB", "RMT", "RMB"]: continue
+        lines.extend(annotation_code_lines('schema.tables["%s"].columns["%s"]' % (table.name, column.name), column.annotations))
+    for fkey in table.foreign_keys:
+        lines.extend(annotation_code_lines('schema.tables["%s"].foreign_keys[(schema,"%s")]' % (table.name, fkey.constraint_name), fkey.annotations))
+    if not lines: return None
+    return "\n".join([
+        "def %s(model):" % (annotation_function_name(table.schema.name, table.name)),
+        '    schema = model.schemas["%s"]' % (table.schema.name),
+        '    table = schema.tables["%s"]' % (table.name),
+    ] + lines) + "\n"
+
 # -- ------------------------------------------------------------------------------------
 def print_schema_annotations(model, schema_name):
     schema =  model.schemas[schema_name]
-    if schema.annotations:
-        print("def update_%s(model):" % (schema.name))
-        print('    schema = model.schemas["%s"]' % (schema.name))
-        print('    # ----------------------------')
-        print('    schema.annotations = ')
-        print('%s' % (json.dumps([schema.annotations], indent=4)))
-        print(')\n')
-        # check annotation keys
-        for key, annotation in schema.annotations.items():
-            if key not in tag2name.keys():
-                print("ERROR: %s -> %s" % (key, json.dumps(annotation, indent=4)))
-                continue
-
+    function_names = []
+    code = schema_annotation_code(schema)
+    if code:
+        print(code)
+        function_names.append(annotation_function_name(schema.name))
     for table in schema.tables.values():
         #if "Curation_Status" in table.columns.elements: add_fkey_source_definitions(table, "Curation_Status", "Status", "curation_status_fkey")
         #if "Record_Status" in table.columns.elements: add_fkey_source_definitions(table, "Record_Status", "Record_Status", "record_status_fkey")
-        if not table.annotations: continue
-        print("def update_%s_%s(model):" % (schema.name, table.name))
-        print('    schema = model.schemas["%s"]' % (schema.name))
-        print('    table = schema.tables["%s"]' % (table.name))
-        
-        for key, annotation in table.annotations.items():
-            if key not in tag2name.keys():
-                print("ERROR: %s -> %s" % (key, json.dumps(annotation, indent=4)))
-                continue
-            if key not in per_schema_annotation_tags: continue
-            print('    # ----------------------------')
-            print('    schema.tables["%s"].%s.update(' % (table.name, tag2name[key]))
-            print('%s' % (json.dumps([annotation], indent=4)))
-            print(')\n')
-                
-        for column in table.columns:
-            if column.name in ["RID", "RCT", "RCB", "RMT", "RMB"]: continue            
-            for key, annotation in column.annotations.items():
-                if key not in tag2name.keys():
-                    print("ERROR: %s -> %s" % (key, json.dumps(annotation, indent=4)))
-                    continue
-                if key not in per_schema_annotation_tags: continue                
-                print('    # ----------------------------')
-                print('    schema.tables["%s"].columns["%s"].%s.update(' % (table.name, column.name, tag2name[key]))
-                print('%s' % (json.dumps([annotation], indent=4)))
-                print(')\n')
-
-        for fkey in table.foreign_keys:
-            if not fkey.annotations: continue
-            for key, annotation in fkey.annotations.items():
-                if key not in tag2name.keys():
-                    print("ERROR: %s -> %s" % (key, json.dumps(annotation, indent=4)))
-                    continue
-                if key not in per_schema_annotation_tags: continue
-                print('    # ----------------------------')
-                print('    schema.tables["%s"].foreign_keys[(schema,"%s")].%s.update(' % (table.name, fkey.constraint_name, tag2name[key]))
-                print('%s' % (json.dumps([annotation], indent=4)))
-                print(')\n')
-            
-        print()
+        code = table_annotation_code(table)
+        if not code: continue
+        print(code)
+        function_names.append(annotation_function_name(schema.name, table.name))
 
     print("def update_%s_annotations(model):" % (schema.name))
-    for table in schema.tables.values():
-        if not table.annotations: continue
-        print('    update_%s_%s(model)' % (schema.name, table.name))
+    for function_name in function_names:
+        print('    %s(model)' % (function_name))
+
+# -- ------------------------------------------------------------------------------------
+ANNOTATION_MODULE_HEADER = '''# generated by atlas_d2k.utils.model.write_annotation_modules from %s
+from deriva.core import tag
+
+true, false, null = True, False, None
+
+'''
+
+ANNOTATION_INDEX_TEMPLATE = '''# generated by atlas_d2k.utils.model.write_annotation_modules. Modules are imported on first use.
+import importlib
+
+# schema name -> update functions (one module per function)
+modules = %s
+
+def _load(name):
+    return getattr(importlib.import_module("." + name, __name__), name)
+
+def __getattr__(name):
+    for names in modules.values():
+        if name in names:
+            return _load(name)
+    raise AttributeError(name)
+
+def update_schema_annotations(model, schema_name):
+    for name in modules.get(schema_name, []):
+        _load(name)(model)
+
+def update_annotations(model):
+    for schema_name in modules.keys():
+        update_schema_annotations(model, schema_name)
+'''
+
+def write_file_if_changed(file_path, content):
+    if os.path.isfile(file_path):
+        with open(file_path) as f:
+            if f.read() == content: return False
+    tmp_file = "%s.tmp" % (file_path)
+    with open(tmp_file, "w") as f:
+        f.write(content)
+    os.replace(tmp_file, file_path)
+    return True
+
+# -- ------------------------------------------------------------------------------------
+# Write one module per annotated schema/table to out_dir (a python package) and an index
+# module (__init__.py) that imports them lazily. The annotation content of each schema/table is
+# fingerprinted in out_dir/annotation_manifest.json, and only the modules whose content changed
+# since the last run are regenerated. Modules of tables that no longer exist (or have no
+# annotations) in the generated schemas are removed.
+# Return {"written": [...], "unchanged": [...], "removed": [...]} (module names)
+def write_annotation_modules(model, out_dir, schema_names=None, source=""):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_file = os.path.join(out_dir, ANNOTATION_MANIFEST_FILE)
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    if schema_names is None:
+        schema_names = list(model.schemas.keys())
+
+    result = {"written": [], "unchanged": [], "removed": []}
+    generated = set()
+    for schema_name in schema_names:
+        schema = model.schemas[schema_name]
+        sites = [ (schema, None, schema_annotation_content(schema)) ]
+        sites.extend([ (table, table.name, table_annotation_content(table)) for table in schema.tables.values() ])
+        for site, table_name, content in sites:
+            name = annotation_function_name(schema_name, table_name)
+            fingerprint = annotation_fingerprint(content)
+            module_file = os.path.join(out_dir, "%s.py" % (name))
+            entry = manifest.get(name)
+            if entry and entry["fingerprint"] == fingerprint and os.path.isfile(module_file):
+                generated.add(name)
+                result["unchanged"].append(name)
+                continue
+            code = schema_annotation_code(site) if table_name is None else table_annotation_code(site)
+            if not code: continue
+            write_file_if_changed(module_file, ANNOTATION_MODULE_HEADER % (source) + code)
+            manifest[name] = {"schema": schema_name, "table": table_name, "fingerprint": fingerprint}
+            generated.add(name)
+            result["written"].append(name)
+
+    for name, entry in list(manifest.items()):
+        if entry["schema"] not in schema_names or name in generated: continue
+        module_file = os.path.join(out_dir, "%s.py" % (name))
+        if os.path.isfile(module_file): os.remove(module_file)
+        del manifest[name]
+        result["removed"].append(name)
+
+    modules = {}
+    for name, entry in sorted(manifest.items(), key=lambda e: (e[1]["schema"], e[1]["table"] or "")):
+        modules.setdefault(entry["schema"], []).append(name)
+    write_file_if_changed(os.path.join(out_dir, "__init__.py"), ANNOTATION_INDEX_TEMPLATE % (json.dumps(modules, indent=4)))
+    write_file_if_changed(manifest_file, json.dumps(manifest, indent=2, sort_keys=True))
+    print("write_annotation_modules: %d written, %d unchanged, %d removed" % (len(result["written"]), len(result["unchanged"]), len(result["removed"])))
+    return result
 
-                               
 # -- ------------------------------------------------------------------------------------
-def print_presence_tag_annotations(model, presence_tags):
-    presence_tag_set = set(presence_tags)
+# AnnotationTagIndex is an inverted index from annotation tag to the model elements (sites)
+# carrying that tag, built in one pass over the model (or over schema_names only).
+# Sites are keyed as in iter_model_nodes. Changes made through set_annotation/pop_annotation
+# keep the index up to date. Changes made directly on element.annotations are not seen, so
+# build a new index (the default of the helpers below) after such changes.
+class AnnotationTagIndex():
+    def __init__(self, model, schema_names=None):
+        self.model = model
+        self.sites = {}     # tag -> { node_key: node }
+        for node_key, node in iter_model_nodes(model, schema_names):
+            for t in node.annotations.keys():
+                self.sites.setdefault(t, {})[node_key] = node
+
+    def tags(self):
+        return [ t for t, sites in self.sites.items() if sites ]
+
+    # return {node_key: node} of elements carrying the tag, optionally restricted to
+    # node kinds (e.g. ["table", "column"]) and to a key prefix (e.g. ("S", "T") for schema S table T)
+    def find(self, t, kinds=None, scope=()):
+        found = {}
+        for node_key, node in self.sites.get(t, {}).items():
+            if kinds and node_key[0] not in kinds: continue
+            if scope and tuple(node_key[1:1+len(scope)]) != tuple(scope): continue
+            found[node_key] = node
+        return found
+
+    def set_annotation(self, node_key, node, t, value):
+        node.annotations[t] = value
+        self.sites.setdefault(t, {})[node_key] = node
+
+    def pop_annotation(self, node_key, node, t):
+        self.sites.get(t, {}).pop(node_key, None)
+        return node.annotations.pop(t, None)
+
+    # remove tags (and tags not in tag.values() if remove_unknown) from the matching sites
+    def clear(self, clear_tags, kinds=None, scope=(), remove_unknown=True):
+        known_tags = set(tag.values())
+        tags = set(clear_tags)
+        if remove_unknown:
+            tags.update([ t for t in self.tags() if t not in known_tags ])
+        cleared = 0
+        for t in tags:
+            for node_key, node in self.find(t, kinds, scope).items():
+                self.pop_annotation(node_key, node, t)
+                cleared += 1
+        return cleared
+
+# -- ------------------------------------------------------------------------------------
+def print_presence_tag_annotations(model, presence_tags, index=None):
+    if not index:
+        index = AnnotationTagIndex(model)
     annotated_dict = {}
-    
-    for schema in model.schemas.values():
-        annotated_set = presence_tag_set.intersection(set(schema.annotations.keys()))
-        if annotated_set:
-            annotated_dict.setdefault((schema.name, None, None), annotated_set)
-        for table in schema.tables.values():
-            annotated_set = presence_tag_set.intersection(set(table.annotations.keys()))            
-            if annotated_set: annotated_dict.setdefault((schema.name, table.name, None), annotated_set)
-            for column in table.columns:
-                #if column.name in ["RID", "RCT", "RMT", "RCB", "RMB", "Curation_Status", "Record_Status", "Record_Status_Detail"]: continue
-                #if column.name in ["RID", "RCT", "RMT", "RCB", "RMB"]: continue
-                annotated_set = presence_tag_set.intersection(set(column.annotations.keys()))            
-                if annotated_set: annotated_dict.setdefault((schema.name, table.name, column.name), annotated_set)
+    for t in presence_tags:
+        for node_key in index.find(t, kinds=["schema", "table", "column"]).keys():
+            sname, tname, cname = (list(node_key[1:]) + [None, None])[0:3]
+            annotated_dict.setdefault((sname, tname, cname), set()).add(t)
 
     print("# ---- presence tags: %s -----" % (presence_tags))
     for key, annotated_set in annotated_dict.items():
@@ -570,36 +1267,78 @@ def print_presence_tag_annotations(model, presence_tags):
 # per_schema_annotation_tags
 # clear_tags: a set of annotation tags to clear
 # NOTE: This function also remove tags that are not in the tag.values()
-def clear_table_annotations(model, schema_name, table_name, clear_tags):
-    table = model.schemas[schema_name].tables[table_name]
-    t_tags = list(table.annotations.keys()).copy()
-    for tt in t_tags:
-        if tt in clear_tags or tt not in tag.values(): table.annotations.pop(tt, None)
-        for column in table.columns:
-            c_tags = list(column.annotations.keys()).copy()
-            for t in c_tags:
-                if t in clear_tags or t not in tag.values(): column.annotations.pop(t, None)
-        for fkey in table.foreign_keys:
-            fk_tags = list(fkey.annotations.keys()).copy()
-            for t in fk_tags:
-                if t in clear_tags or t not in tag.values(): fkey.annotations.pop(t, None)
+# NOTE: the table, its columns, and its foreign keys are cleared.
+def clear_table_annotations(model, schema_name, table_name, clear_tags, index=None):
+    if not index:
+        index = AnnotationTagIndex(model, [schema_name])
+    index.clear(clear_tags, kinds=["table", "column", "fkey"], scope=(schema_name, table_name))
 
 # ---------------------------------------------------------------------------------------                
 # NOTE: This function also remove tags that are not in the tag.values()
-def clear_schema_annotations(model, schema_name, clear_tags):
-    schema = model.schemas[schema_name]
-    s_tags = list(schema.annotations.keys()).copy()
-    for t in s_tags:
-        if t in clear_tags or t not in tag.values(): schema.annotations.pop(t, None)
-    for table in schema.tables.values():
-        clear_table_annotations(model, schema_name, table.name, clear_tags)
+def clear_schema_annotations(model, schema_name, clear_tags, index=None):
+    if not index:
+        index = AnnotationTagIndex(model, [schema_name])
+    index.clear(clear_tags, kinds=["schema", "table", "column", "fkey"], scope=(schema_name,))
 
 # ---------------------------------------------------------------------------------------        
-def clear_all_schema_annotations(model, clear_tags):
-    for schema in model.schemas.values():
-        clear_schema_annotations(model, schema.name, clear_tags)
+def clear_all_schema_annotations(model, clear_tags, index=None):
+    if not index:
+        index = AnnotationTagIndex(model, list(model.schemas.keys()))
+    index.clear(clear_tags, kinds=["schema", "table", "column", "fkey"])
 
 # ---------------------------------------------------------------------------------------        
 def clear_catalog_annotations(model, clear_tags):
     for t in clear_tags:
         if t in model.annotations: model.annotations.pop(t, None)
+
+# ======================================================
+# ---------------------------------------------------------------------------------------
+# compute the annotation changes needed to turn existing into desired. Elements that do not
+# exist in the existing model are skipped (structure changes are not handled here).
+# return a list of {"key": node_key, "path": annotation path, "set": {tag: value}, "delete": [tag]}
+def diff_model_annotations(desired, existing):
+    existing_nodes = dict(iter_model_nodes(existing))
+    changes = []
+    for node_key, node in iter_model_nodes(desired):
+        old_node = existing_nodes.get(node_key)
+        if old_node is None:
+            print("WARNING: %s doesn't exist in the catalog. Skip its annotations" % (node_key,))
+            continue
+        new_annotations = node.annotations
+        old_annotations = old_node.annotations
+        to_set = { t: v for t, v in new_annotations.items() if t not in old_annotations or old_annotations[t] != v }
+        to_delete = [ t for t in old_annotations.keys() if t not in new_annotations ]
+        if to_set or to_delete:
+            changes.append({"key": node_key, "path": annotation_uri_path(node_key, node), "set": to_set, "delete": to_delete, "annotations": new_annotations})
+    return changes
+
+# ---------------------------------------------------------------------------------------
+# apply only the changed annotations of the model to the catalog, instead of model.apply()
+# which PUTs every annotation. Per element, a single changed key is PUT (or DELETEd) at
+# .../annotation/<tag>. Elements with several changed keys are replaced with a single PUT
+# of the whole annotation document.
+# NOTE: acls and comments are not applied. Use model.apply() for those.
+def apply_annotation_diff(model, existing=None, dry_run=False):
+    if existing is None:
+        existing = model.fromcatalog(model.catalog)
+    changes = diff_model_annotations(model, existing)
+    nrequests = 0
+    for change in changes:
+        path = change["path"]
+        if len(change["set"]) + len(change["delete"]) > 1:
+            requests = [ ("PUT", path, change["annotations"]) ]
+        elif change["set"]:
+            t, v = list(change["set"].items())[0]
+            requests = [ ("PUT", "%s/%s" % (path, urlquote(t)), v) ]
+        else:
+            requests = [ ("DELETE", "%s/%s" % (path, urlquote(change["delete"][0])), None) ]
+        for method, url, value in requests:
+            print("  %s %s" % (method, url))
+            nrequests += 1
+            if dry_run: continue
+            if method == "PUT":
+                request(model.catalog, "put", url, json=value)
+            else:
+                request(model.catalog, "delete", url)
+    print("apply_annotation_diff: %d elements changed, %d requests%s" % (len(changes), nrequests, " (dry run)" if dry_run else ""))
+    return changes
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+import sys
+
+# -- =================================================================================
+# -- model policy checker
+#
+# Rules are checked against the json representation of the model (model.prejson()), so large
+# models can be sharded by schema across processes. A rule is a function (node_key, doc) that
+# returns a list of violation messages, or of dicts with a "message" and the offending values in
+# other fields, which are copied into the violation. Node keys are the same as in
+# model.iter_model_nodes e.g. ("table", sname, tname). Register new rules with @policy_rule(kinds).
+#
+policy_rules = {}       # rule name -> (kinds, function)
+
+ACL_TYPES = ["owner", "create", "write", "insert", "update", "delete", "select", "enumerate"]
+BINDING_PROJECTION_TYPES = ["acl", "nonnull"]
+
+def policy_rule(kinds):
+    def register(func):
+        policy_rules[func.__name__] = (kinds, func)
+        return func
+    return register
+
+# ----------------------------------------------------------
+# create/write are not allowed in acls of any element
+@policy_rule(["catalog", "schema", "table", "column", "fkey"])
+def forbidden_acl_types(node_key, doc):
+    acls = doc.get("acls") or {}
+    return [ {"message": "%s acl is not allowed: %s" % (t, acls[t]), "acl_type": t, "acl": acls[t]} for t in ["create", "write"] if t in acls.keys() ]
+
+# ----------------------------------------------------------
+@policy_rule(["catalog", "schema", "table", "column", "fkey"])
+def unknown_acl_types(node_key, doc):
+    acls = doc.get("acls") or {}
+    return [ "unknown acl type %s" % (t) for t in acls.keys() if t not in ACL_TYPES ]
+
+# ----------------------------------------------------------
+# foreign keys should define the default insert and update acls e.g. {"insert": ["*"], "update": ["*"]}
+@policy_rule(["fkey"])
+def missing_default_fkey_acls(node_key, doc):
+    acls = doc.get("acls") or {}
+    return [ "missing %s acl" % (t) for t in ["insert", "update"] if t not in acls.keys() ]
+
+# ----------------------------------------------------------
+@policy_rule(["table", "column", "fkey"])
+def malformed_acl_bindings(node_key, doc):
+    violations = []
+    for name, binding in (doc.get("acl_bindings") or {}).items():
+        if binding is False:
+            continue
+        if not isinstance(binding, dict):
+            violations.append("acl_binding %s is not an object or false" % (name))
+            continue
+        for attr in ["types", "projection", "scope_acl"]:
+            if attr not in binding.keys():
+                violations.append("acl_binding %s is missing %s" % (name, attr))
+        if not isinstance(binding.get("types", []), list) or [ t for t in binding.get("types", []) if t not in ACL_TYPES ]:
+            violations.append("acl_binding %s has invalid types %s" % (name, binding.get("types")))
+        if not isinstance(binding.get("scope_acl", []), list):
+            violations.append("acl_binding %s has invalid scope_acl %s" % (name, binding.get("scope_acl")))
+        if binding.get("projection_type", "acl") not in BINDING_PROJECTION_TYPES:
+            violations.append("acl_binding %s has invalid projection_type %s" % (name, binding.get("projection_type")))
+    return violations
+
+# ----------------------------------------------------------
+def constraint_name(doc):
+    names = doc.get("names") or [[None, None]]
+    return (names[0][0], names[0][1])
+
+# ----------------------------------------------------------
+# iterate over the elements of a schema document. Yield (node_key, doc)
+def iter_schema_docs(sname, schema_doc):
+    yield ("schema", sname), schema_doc
+    for tname, table_doc in schema_doc.get("tables", {}).items():
+        yield ("table", sname, tname), table_doc
+        for column_doc in table_doc.get("column_definitions", []):
+            yield ("column", sname, tname, column_doc["name"]), column_doc
+        for key_doc in table_doc.get("keys", []):
+            yield ("key", sname, tname) + constraint_name(key_doc), key_doc
+        for fkey_doc in table_doc.get("foreign_keys", []):
+            yield ("fkey", sname, tname) + constraint_name(fkey_doc), fkey_doc
+
+# ----------------------------------------------------------
+def check_node(node_key, doc, rule_names):
+    violations = []
+    for rule_name in rule_names:
+        kinds, func = policy_rules[rule_name]
+        if node_key[0] not in kinds: continue
+        for message in func(node_key, doc):
+            if not isinstance(message, dict):
+                message = {"message": message}
+            violations.append(dict({"rule": rule_name, "node": list(node_key)}, **message))
+    return violations
+
+# ----------------------------------------------------------
+def check_schema_doc(sname, schema_doc, rule_names):
+    violations = []
+    for node_key, doc in iter_schema_docs(sname, schema_doc):
+        violations.extend(check_node(node_key, doc, rule_names))
+    return violations
+
+# ----------------------------------------------------------
+# check all rules (or the named rules) over the model in one traversal and return all violations:
+#   [ {"rule": rule name, "node": node key, "message": ..., <other fields of the rule>} ]
+# With workers > 1, schemas are checked in parallel processes.
+def check_model_policies(model, rule_names=None, workers=1):
+    if rule_names is None:
+        rule_names = list(policy_rules.keys())
+    model_doc = model.prejson() if hasattr(model, "prejson") else model
+    violations = check_node(("catalog",), model_doc, rule_names)
+    schema_docs = model_doc.get("schemas", {})
+    if workers > 1 and len(schema_docs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [ executor.submit(check_schema_doc, sname, sdoc, rule_names) for sname, sdoc in schema_docs.items() ]
+            for f in futures:
+                violations.extend(f.result())
+    else:
+        for sname, sdoc in schema_docs.items():
+            violations.extend(check_schema_doc(sname, sdoc, rule_names))
+    return violations
+
+# ----------------------------------------------------------
+def policy_report(violations):
+    summary = {}
+    for v in violations:
+        summary[v["rule"]] = summary.get(v["rule"], 0) + 1
+    return {"violations": len(violations), "summary": summary, "details": violations}
+
+# ----------------------------------------------------------
+def print_policy_report(report):
+    print("=========== policy violations: %d ============" % (report["violations"]))
+    for rule_name, n in report["summary"].items():
+        print("  %s: %d" % (rule_name, n))
+    for v in report["details"]:
+        print("%s %s: %s" % (v["rule"], ".".join([ str(n) for n in v["node"] ]), v["message"]))
@@ -1,12 +1,24 @@
 #!/usr/bin/python
 
 import sys
+import os
 import json
-from deriva.core import ErmrestCatalog, AttrDict, get_credential, DEFAULT_CREDENTIAL_FILE, tag, urlquote, DerivaServer, get_credential, BaseCLI
-from deriva.core.ermrest_model import builtin_types, Schema, Table, Column, Key, ForeignKey
-from deriva.core import urlquote, urlunquote, DEFAULT_SESSION_CONFIG
-
-import argparse
+import copy
+import re
+import time
+import random
+import threading
+import fcntl
+import itertools
+import logging
+import uuid
+import functools
+import inspect
+import atexit
+import weakref
+import requests
+from contextlib import contextmanager
+from deriva.core import tag, BaseCLI, ErmrestCatalog, HatracStore, get_credential, DEFAULT_SESSION_CONFIG, DEFAULT_CHUNK_SIZE
 
 # -- define ddctx cid string
 # 
@@ -39,38 +51,831 @@ session_config_write_retry = DEFAULT_SESSION_CONFIG.copy()
 session_config_write_retry.update({
     # our PUT/POST to ermrest is idempotent
     "allow_retry_on_all_methods": True,
-    # do more retries before aborting
-    "retry_read": 8,
-    "retry_connect": 5,
-    # increase delay factor * 2**(n-1) for Nth retry
-    "retry_backoff_factor": 5,
+    # a few quick retries in the session. Longer outages are handled by the retry layer
+    # (see request) with jitter and a deadline, instead of factor * 2**(n-1) sleeps here
+    "retry_read": 2,
+    "retry_connect": 2,
+    "retry_backoff_factor": 1,
 })
 # need to be passed to the DerivaServer constructure e.g. server = DerivaServer("https", server_name, credentials, session_config=session_config_write_retry)
 
 # ======================================================================
 
+# -- performance profiles
+# Batch sizes, concurrency, and retry settings used by the data and hatrac helpers when the
+# caller doesn't specify them. The profile is chosen by the host classification (prod,
+# staging, dev) unless Config.profile_name is set (see --perf-profile). Profiles in
+# DEFAULT_PERF_PROFILE_FILE (or --perf-profiles) override these values, e.g.
+#   {"prod": {"hatrac_workers": 1}, "bulk": {"insert_batch_rows": 20000}}
+# A new profile name starts from the dev profile.
+DEFAULT_PERF_PROFILE_FILE = os.path.expanduser("~/.deriva/atlas_d2k/perf_profiles.json")
+
+DEFAULT_PERF_PROFILES = {
+    "dev": {
+        "insert_batch_rows": 10000,         # rows per entity POST
+        "insert_batch_bytes": 1000000,      # max json bytes per entity POST
+        "update_batch_rows": 10000,         # rows per attributegroup PUT
+        "update_batch_bytes": 2000000,      # max json bytes per attributegroup PUT
+        "read_batch_rows": 5000,            # rows per page of get_entities
+        "hatrac_workers": 4,                # concurrent transfers in upload_files
+        "hatrac_walk_workers": 8,           # concurrent requests in walk_hatrac_namespaces
+        "hatrac_chunk_bytes": DEFAULT_CHUNK_SIZE,
+        "hatrac_read_ahead": 1,             # staging windows in flight in upload_files
+        # deriva session config retry settings
+        "retry": {"retry_read": 2, "retry_connect": 2, "retry_backoff_factor": 1},
+        # retry layer of the request helpers, see RetryPolicy and CircuitBreaker
+        "retry_policy": {
+            "idempotent": {"retries": 6, "base_delay": 1, "max_delay": 60, "deadline": 900},
+            "non_idempotent": {"retries": 3, "base_delay": 2, "max_delay": 60, "deadline": 300},
+        },
+        "circuit_breaker": {"failure_threshold": 8, "reset_timeout": 30},
+        # max concurrent requests per host across the processes of this machine, see HostAdmission
+        "admission": {"slots": 8, "timeout": 600},
+        # used by the --dry-run cost estimate when the run has no measured reads
+        "est_latency": 0.3,                 # seconds per request
+        "est_bandwidth": 20 * 1024 * 1024,  # bytes per second
+    },
+}
+DEFAULT_PERF_PROFILES["staging"] = copy.deepcopy(DEFAULT_PERF_PROFILES["dev"])
+# prod also serves users: smaller batches and less concurrency
+DEFAULT_PERF_PROFILES["prod"] = copy.deepcopy(DEFAULT_PERF_PROFILES["dev"])
+DEFAULT_PERF_PROFILES["prod"].update({
+    "insert_batch_rows": 5000,
+    "update_batch_rows": 5000,
+    "hatrac_workers": 2,
+    "hatrac_walk_workers": 4,
+    "admission": {"slots": 4, "timeout": 600},
+})
+
+def merge_dict(base, overrides):
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(base.get(k), dict):
+            merge_dict(base[k], v)
+        else:
+            base[k] = v
+    return base
+
 class Config():
     host = None
     is_prod = False
     is_staging = False
     is_dev = False
+    dry_run = False
+    profile_name = None
+    profile_file = DEFAULT_PERF_PROFILE_FILE
+    profiles = None
     
     def __init__(self):
         pass
     
     def apply_hostname(self, host):
         self.host = host
+        self.is_prod, self.is_staging, self.is_dev = False, False, False
         if host in ["www.atlas-d2k.org", "www.gudmap.org", "www.rebuildingakidney.org"]:
             self.is_prod = True
         elif host in ["staging.atlas-d2k.org", "staging.gudmap.org", "staging.rebuildingakidney.org"]:
             self.is_staging = True
         else:
             self.is_dev = True
+
+    def environment(self):
+        if self.is_prod: return "prod"
+        if self.is_staging: return "staging"
+        return "dev"
+
+    def load_profiles(self, profile_file=None):
+        if profile_file is None:
+            profile_file = self.profile_file
+        profiles = copy.deepcopy(DEFAULT_PERF_PROFILES)
+        if profile_file and os.path.exists(profile_file):
+            with open(profile_file) as f:
+                overrides = json.load(f)
+            for name, values in overrides.items():
+                profile = profiles.setdefault(name, copy.deepcopy(DEFAULT_PERF_PROFILES["dev"]))
+                merge_dict(profile, values)
+        self.profiles = profiles
+        return profiles
+
+    def get_profile(self):
+        if self.profiles is None:
+            self.load_profiles()
+        name = self.profile_name or self.environment()
+        if name not in self.profiles:
+            raise ValueError("unknown performance profile %s (known: %s)" % (name, ", ".join(self.profiles.keys())))
+        return self.profiles[name]
+
+    # return value if given, otherwise the setting of the current profile e.g.
+    #   batch_size = cfg.perf("insert_batch_rows", batch_size)
+    def perf(self, name, value=None):
+        return self.get_profile()[name] if value is None else value
+
+    # deriva session config with the retry settings of the current profile
+    def session_config(self, write=False):
+        session_config = DEFAULT_SESSION_CONFIG.copy()
+        session_config.update(self.get_profile()["retry"])
+        if write:
+            session_config["allow_retry_on_all_methods"] = True
+        return session_config
             
     def print(self):
-        print("host:%s, is_prod=%s, is_staging=%s, is_dev=%s" % (self.host, self.is_prod, self.is_staging, self.is_dev))
+        print("host:%s, is_prod=%s, is_staging=%s, is_dev=%s, profile=%s" % (self.host, self.is_prod, self.is_staging, self.is_dev, self.profile_name or self.environment()))
+
+# -- =================================================================================
+# -- per-catalog context
+#
+# A CatalogContext carries the state the helpers need for one host/catalog: the host config and
+# performance profile (ctx.cfg), the catalog and store bindings with their sessions, the caches
+# (group, key and term resolvers, retry policies) and the scratch directories. Contexts of
+# different hosts can be used by the threads of one process, e.g. to copy from prod to dev:
+#   prod = CatalogContext("www.atlas-d2k.org", 2)
+#   dev = CatalogContext("dev.atlas-d2k.org", 2)
+#   rows = get_entities(prod.catalog, "Vocabulary", "Anatomy")         # prod profile
+#   insert_if_not_exist(dev.catalog, "Vocabulary", "Anatomy", rows)    # dev profile
+# The helpers take an optional ctx. Without it, get_context returns the context that created
+# the binding (ctx.catalog, ctx.store or ctx.bind), then the context activated in the thread
+# (with ctx.activate()), then default_context, which AtlasD2KCLI.parse_cli configures from the
+# command line. cfg is default_context.cfg. Keep a reference to a context while its bindings are
+# in use: bindings only hold a weak reference to their context.
+# The caches hand out objects that lock their own state (KeyResolver, ErmrestGroupResolver) or
+# are read-only after construction (TermNormalizer), so threads can share a context.
+# Circuit breakers and admission slots are per host for the whole process, since they protect
+# the host rather than the catalog.
+#
+DEFAULT_SCRATCH_DIR = "/scratch"
+
+class CatalogContext():
+    def __init__(self, host=None, catalog_id=None, credentials=None, **kwargs):
+        self.cfg = Config()
+        self.lock = threading.RLock()
+        self.caches = {}
+        self.creating = {}
+        self._cost_estimate = None
+        self.configure(host, catalog_id, credentials, **kwargs)
+
+    # (re)configure the context. Bindings and caches of the previous configuration are dropped.
+    def configure(self, host=None, catalog_id=None, credentials=None, credential_file=None, profile_name=None,
+                  profile_file=DEFAULT_PERF_PROFILE_FILE, dry_run=False, scratch_dir=DEFAULT_SCRATCH_DIR, scratch_dirs={}):
+        with self.lock:
+            self.host = host
+            self.catalog_id = catalog_id
+            self.credentials = credentials
+            self.credential_file = credential_file
+            self.scratch_dir = scratch_dir
+            self.scratch_dirs = dict(scratch_dirs)
+            if host:
+                self.cfg.apply_hostname(host)
+            self.cfg.profile_name = profile_name
+            self.cfg.profile_file = profile_file
+            self.cfg.profiles = None
+            self.cfg.dry_run = dry_run
+            self.caches = {}
+            self._catalog = None
+            self._store = None
+        return self
+
+    def get_credentials(self):
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = get_credential(self.host, self.credential_file)
+            return self.credentials
+
+    # associate a binding (e.g. a catalog created by the caller) with this context. The map holds
+    # a weak reference, since the context holds its own bindings.
+    def bind(self, binding):
+        binding_contexts[binding] = weakref.ref(self)
+        return binding
+
+    @property
+    def catalog(self):
+        with self.lock:
+            if self._catalog is None:
+                self._catalog = self.bind(ErmrestCatalog("https", self.host, self.catalog_id, self.get_credentials(), session_config=self.cfg.session_config()))
+            return self._catalog
+
+    @property
+    def store(self):
+        with self.lock:
+            if self._store is None:
+                self._store = self.bind(HatracStore("https", self.host, self.get_credentials(), session_config=self.cfg.session_config()))
+            return self._store
+
+    # dry run cost estimate of the requests and transfers of this context (see CostEstimate)
+    @property
+    def cost_estimate(self):
+        with self.lock:
+            if self._cost_estimate is None:
+                self._cost_estimate = CostEstimate(self)
+            return self._cost_estimate
+
+    # named cache of the context e.g. ctx.cache("ermrest_groups")
+    def cache(self, name):
+        with self.lock:
+            return self.caches.setdefault(name, {})
+
+    # return the cached value of key, or create it with factory(). Only the first caller of a
+    # key runs factory; callers of other keys are not blocked while it runs.
+    def get_cached(self, name, key, factory):
+        with self.lock:
+            cache = self.caches.setdefault(name, {})
+            if key in cache:
+                return cache[key]
+            key_lock = self.creating.setdefault((name, key), threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in cache:
+                    return cache[key]
+            value = factory()
+            with self.lock:
+                cache[key] = value
+                self.creating.pop((name, key), None)
+            return value
+
+    # scratch directory of a pipeline step e.g. ctx.scratch_path("hatrac") -> /scratch/hatrac
+    def scratch_path(self, name, *parts):
+        return os.path.join(self.scratch_dirs.get(name) or os.path.join(self.scratch_dir, name), *parts)
+
+    # make this context the default of the helpers called by the current thread
+    @contextmanager
+    def activate(self):
+        stack = context_local.__dict__.setdefault("stack", [])
+        stack.append(self)
+        try:
+            yield self
+        finally:
+            stack.pop()
+
+    def print(self):
+        print("catalog: %s/%s, scratch_dir=%s" % (self.host, self.catalog_id, self.scratch_dir))
+        self.cfg.print()
+
+# ----------------------------------------------------------
+binding_contexts = weakref.WeakKeyDictionary()
+context_local = threading.local()
+
+def get_context(ctx=None, binding=None):
+    if ctx is not None:
+        return ctx
+    if binding is not None:
+        ctx_ref = binding_contexts.get(binding)
+        ctx = ctx_ref() if ctx_ref is not None else None
+        if ctx is not None:
+            return ctx
+    stack = getattr(context_local, "stack", None)
+    if stack:
+        return stack[-1]
+    return default_context
+
+default_context = CatalogContext()
+cfg = default_context.cfg
+
+# -- =================================================================================
+# -- retry layer
+#
+# All catalog and store requests of the atlas_d2k helpers go through request() (or
+# call_with_retry() for calls like store.put_loc). Failed calls are retried with decorrelated
+# jitter (each delay is drawn between base_delay and 3x the previous delay, capped at
+# max_delay) so that parallel workers don't retry in lockstep, until the retries or the
+# deadline (seconds per call) run out.
+#  - idempotent calls (GET, HEAD, PUT, DELETE, POST with onconflict=skip) are retried on
+#    connection errors, timeouts, and 429/500/502/503/504
+#  - non-idempotent calls are only retried when the server didn't process the request
+#    (connection refused, 429, 503)
+# A per-host circuit breaker opens after failure_threshold consecutive server failures. While
+# open, calls to the host fail fast with CircuitOpenError. After reset_timeout seconds, one
+# call is let through and closes the circuit if it succeeds.
+# The settings come from the "retry_policy" and "circuit_breaker" of the performance profile.
+#
+class CircuitOpenError(Exception):
+    """ Raised without sending the request while the circuit breaker of the host is open
+    """
+    pass
+
+class RetryPolicy():
+    def __init__(self, retries=6, base_delay=1, max_delay=60, deadline=900, retry_statuses=[429, 500, 502, 503, 504], retry_read_errors=True):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+        self.retry_read_errors = retry_read_errors
+
+    # decorrelated jitter
+    def backoff(self, previous_delay):
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)))
+
+    def is_retryable(self, e):
+        if isinstance(e, requests.exceptions.HTTPError):
+            return e.response is not None and e.response.status_code in self.retry_statuses
+        if is_connect_error(e):
+            return True
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return self.retry_read_errors
+        return False
+
+# ----------------------------------------------------------
+# the request was not sent: connection refused, dns failure, or connect timeout
+def is_connect_error(e):
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return re.search("NewConnectionError|Failed to establish a new connection|NameResolutionError", str(e)) is not None
+    return False
+
+# ----------------------------------------------------------
+# an error that counts against the health of the server
+def is_server_failure(e):
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in [429, 500, 502, 503, 504]
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+# ----------------------------------------------------------
+class CircuitBreaker():
+    def __init__(self, host, failure_threshold=8, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    # return True if the call is the trial call of a half open circuit
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self.trial or time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("circuit breaker for %s is open after %d failures" % (self.host, self.failures))
+            # -- half open: let one call through
+            self.trial = True
+            return True
+
+    # the trial call ended without an outcome (e.g. no admission): let the next call try
+    def cancel_trial(self):
+        with self.lock:
+            self.trial = False
+
+    def record(self, failed):
+        with self.lock:
+            self.trial = False
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print("WARNING: circuit breaker for %s opened after %d failures" % (self.host, self.failures))
+                self.opened_at = time.time()
+
+# ----------------------------------------------------------
+circuit_breakers = {}
+retry_lock = threading.Lock()
+
+def get_retry_policy(idempotent=True, ctx=None):
+    ctx = get_context(ctx)
+    name = "idempotent" if idempotent else "non_idempotent"
+    if idempotent:
+        return ctx.get_cached("retry_policies", name, lambda: RetryPolicy(**ctx.cfg.perf("retry_policy")[name]))
+    return ctx.get_cached("retry_policies", name, lambda: RetryPolicy(retry_statuses=[429, 503], retry_read_errors=False, **ctx.cfg.perf("retry_policy")[name]))
+
+# the settings come from the profile of the first context that calls the host
+def get_circuit_breaker(host, ctx=None):
+    with retry_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(host, **get_context(ctx).cfg.perf("circuit_breaker"))
+        return circuit_breakers[host]
+
+# -- =================================================================================
+# -- per-host admission control
+#
+# HostAdmission limits the number of concurrent requests to a host across all processes (cron
+# jobs, pipeline workers) and threads on this machine. Each slot is a lock file
+# <lock_dir>/<host>.<n>.lock held with flock while a request is in flight. Locks are released
+# by the kernel if a process dies. Waiting callers poll the slots with a jittered delay and
+# raise AdmissionTimeoutError after timeout seconds. slots=0 disables the limit, as do slot files
+# that can't be opened by this user. Long hatrac transfers are not admitted per host (see
+# call_with_retry).
+#
+DEFAULT_ADMISSION_LOCK_DIR = "/tmp/atlas_d2k_admission"
+
+class AdmissionTimeoutError(Exception):
+    """ Raised when no request slot of the host is freed within the admission timeout
+    """
+    pass
+
+class HostAdmission():
+    def __init__(self, host, slots=8, timeout=600, lock_dir=DEFAULT_ADMISSION_LOCK_DIR):
+        self.host = host
+        self.slots = slots
+        self.timeout = timeout
+        self.lock_dir = lock_dir
+        self.unusable = set()
+        if slots:
+            if not os.path.isdir(lock_dir):
+                os.makedirs(lock_dir, exist_ok=True)
+                try:
+                    # -- shared by the users of the machine
+                    os.chmod(lock_dir, 0o1777)
+                except OSError:
+                    pass
+
+    def slot_file(self, n):
+        return os.path.join(self.lock_dir, "%s.%d.lock" % (self.host, n))
+
+    # -- flock works on a read-only descriptor, so slot files created by another user only need to
+    #    be readable. Slots that can't be opened at all are skipped.
+    def try_slot(self, n):
+        try:
+            fd = os.open(self.slot_file(n), os.O_RDONLY | os.O_CREAT, 0o666)
+        except PermissionError:
+            self.unusable.add(n)
+            return None
+        try:
+            # -- the umask drops the group/other bits of a new file
+            os.fchmod(fd, 0o666)
+        except OSError:
+            pass
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+    @contextmanager
+    def acquire(self):
+        if not self.slots:
+            yield
+            return
+        started = time.time()
+        waited = started
+        delay = 0.01
+        fd = None
+        while fd is None:
+            slots = [ n for n in range(self.slots) if n not in self.unusable ]
+            if not slots:
+                print("WARNING: %s: no usable request slot in %s, admission control disabled" % (self.host, self.lock_dir))
+                self.slots = 0
+                yield
+                return
+            for n in random.sample(slots, len(slots)):
+                fd = self.try_slot(n)
+                if fd is not None: break
+            if fd is None and len(self.unusable) < self.slots:
+                if self.timeout and time.time() - started > self.timeout:
+                    raise AdmissionTimeoutError("no request slot for %s within %ds (%d slots)" % (self.host, self.timeout, self.slots))
+                delay = min(0.5, random.uniform(0.01, delay * 3))
+                time.sleep(delay)
+                waited = time.time()
+        run_stats.add_admission(waited - started)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+# ----------------------------------------------------------
+host_admissions = {}
+
+def get_host_admission(host, ctx=None):
+    with retry_lock:
+        if host not in host_admissions:
+            host_admissions[host] = HostAdmission(host, **get_context(ctx).cfg.perf("admission"))
+        return host_admissions[host]
+
+# -- =================================================================================
+# -- request tracing
+#
+# Every request sent through request() carries the run ID of the process and the path of the
+# current operations in its deriva-client-context header, e.g.
+#   {"cid": "cli/ingest/...", "run": "3f2a9c1b7d4e", "op": "insert_if_exist_update-3/insert_if_not_exist-4/batch-5"}
+# so the ERMrest/hatrac logs can be matched with the client operations and batches. Client
+# timing of operations and requests is logged to the atlas_d2k.trace logger under the same IDs
+# (see --trace-log).
+# Operations are tracked per thread. Helpers running in worker threads start their own
+# top-level operations.
+#
+RUN_ID = uuid.uuid4().hex[0:12]
+
+# -- run statistics of the process, reported by RunProfiler (--profile)
+class RunStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.call_seconds = 0.0         # summed over threads
+        self.admission_seconds = 0.0
+        self.retries = 0
+        self.retry_seconds = 0.0
+        self.ops = {}                   # operation name -> [count, seconds]
+
+    def add_call(self, seconds):
+        with self.lock:
+            self.calls += 1
+            self.call_seconds += seconds
+
+    def add_admission(self, seconds):
+        with self.lock:
+            self.admission_seconds += seconds
+
+    def add_retry(self, seconds):
+        with self.lock:
+            self.retries += 1
+            self.retry_seconds += seconds
+
+    def add_op(self, name, seconds):
+        with self.lock:
+            stat = self.ops.setdefault(name, [0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+
+run_stats = RunStats()
+
+trace_logger = logging.getLogger("atlas_d2k.trace")
+# -- only written to --trace-log, not to the console log of the scripts
+trace_logger.propagate = False
+trace_logger.addHandler(logging.NullHandler())
+trace_local = threading.local()
+op_counter = itertools.count(1)
+
+def current_op():
+    ops = getattr(trace_local, "ops", [])
+    return ops[-1] if ops else None
+
+@contextmanager
+def trace_operation(name, **attrs):
+    ops = getattr(trace_local, "ops", None)
+    if ops is None:
+        ops = trace_local.ops = []
+    op = "%s-%d" % (name, next(op_counter))
+    op_path = "%s/%s" % (ops[-1], op) if ops else op
+    ops.append(op_path)
+    started = time.time()
+    trace_logger.debug("run=%s op=%s start %s" % (RUN_ID, op_path, json.dumps(attrs, default=str)))
+    status = "error"
+    try:
+        yield op_path
+        status = "ok"
+    finally:
+        ops.pop()
+        run_stats.add_op(name, time.time() - started)
+        trace_logger.info("run=%s op=%s %s %.3fs %s" % (RUN_ID, op_path, status, time.time() - started, json.dumps(attrs, default=str)))
+
+# ----------------------------------------------------------
+# decorator running each call of the function as an operation named after the function.
+# attr_names are the arguments logged with the operation. "row.RID" logs row["RID"].
+def traced(*attr_names):
+    def decorator(func):
+        signature = inspect.signature(func)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            attrs = {}
+            for attr_name in attr_names:
+                arg_name, sep, key = attr_name.partition(".")
+                if arg_name not in arguments: continue
+                value = arguments[arg_name]
+                attrs[attr_name] = value.get(key) if sep and isinstance(value, dict) else value
+            with trace_operation(func.__name__, **attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ----------------------------------------------------------
+# the deriva-client-context entries of the current operation
+def trace_context():
+    context = {"run": RUN_ID}
+    op = current_op()
+    if op: context["op"] = op
+    return context
 
-cfg = Config()
+# headers with the trace context merged into the deriva-client-context
+def trace_headers(headers=None):
+    headers = dict(headers or {})
+    context = dict(headers.get("deriva-client-context", {}))
+    context.update(trace_context())
+    headers["deriva-client-context"] = context
+    return headers
+
+# ----------------------------------------------------------
+# host name of a catalog or a store
+def binding_host(binding):
+    return re.sub("^[a-z]+://", "", binding._server_uri).split("/")[0]
+
+# ----------------------------------------------------------
+def timed_call(func, *args, **kwargs):
+    started = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        run_stats.add_call(time.time() - started)
+
+# ----------------------------------------------------------
+# call func(*args, **kwargs) with retries. deadline overrides the deadline of the policy.
+# admission=False skips the host admission for long transfers (e.g. hatrac put_loc/get_obj) that
+# would hold a request slot for minutes. They are limited by hatrac_workers instead.
+def call_with_retry(func, *args, host=None, idempotent=True, policy=None, deadline=None, ctx=None, admission=True, **kwargs):
+    if policy is None:
+        policy = get_retry_policy(idempotent, ctx)
+    deadline_at = time.time() + (deadline if deadline is not None else policy.deadline)
+    breaker = get_circuit_breaker(host, ctx) if host else None
+    delay = policy.base_delay
+    attempt = 0
+    while True:
+        trial = breaker.before_call() if breaker else False
+        try:
+            if host and admission:
+                with get_host_admission(host, ctx).acquire():
+                    result = timed_call(func, *args, **kwargs)
+            else:
+                result = timed_call(func, *args, **kwargs)
+        except AdmissionTimeoutError:
+            if trial: breaker.cancel_trial()
+            raise
+        except Exception as e:
+            if breaker: breaker.record(is_server_failure(e))
+            attempt += 1
+            if not policy.is_retryable(e) or attempt > policy.retries:
+                raise
+            delay = policy.backoff(delay)
+            if time.time() + delay > deadline_at:
+                raise
+            print("WARNING: %s: retry %d/%d in %.1fs: %s" % (host, attempt, policy.retries, delay, e))
+            run_stats.add_retry(delay)
+            time.sleep(delay)
+            continue
+        except BaseException:
+            # -- e.g. KeyboardInterrupt: no outcome to record
+            if trial: breaker.cancel_trial()
+            raise
+        if breaker: breaker.record(False)
+        return result
+
+# ----------------------------------------------------------
+# the request choke point of the helpers e.g. request(catalog, "get", url).
+# idempotent defaults to True except for POST.
+# In dry run mode (ctx.cfg.dry_run), POST/PUT/DELETE are not sent but counted in ctx.cost_estimate.
+# Their response echoes the request body.
+def request(binding, method, path, idempotent=None, deadline=None, ctx=None, **kwargs):
+    ctx = get_context(ctx, binding)
+    if idempotent is None:
+        idempotent = (method != "post")
+    kwargs["headers"] = trace_headers(kwargs.get("headers"))
+    host = binding_host(binding)
+    if ctx.cfg.dry_run and method in ["post", "put", "delete"]:
+        nbytes = len(json.dumps(kwargs["json"])) if kwargs.get("json") is not None else 0
+        ctx.cost_estimate.add_write(nbytes, nbytes if method != "delete" else 0)
+        trace_logger.debug("run=%s op=%s %s %s%s dry run (%d bytes)" % (RUN_ID, current_op(), method.upper(), host, path, nbytes))
+        return DryRunResponse(kwargs.get("json") if method != "delete" else None)
+    started = time.time()
+    status = "error"
+    try:
+        resp = call_with_retry(getattr(binding, method), path, host=host, idempotent=idempotent, deadline=deadline, ctx=ctx, **kwargs)
+        status = resp.status_code
+        if ctx.cfg.dry_run:
+            nbytes = len(json.dumps(kwargs["json"])) if kwargs.get("json") is not None else 0
+            ctx.cost_estimate.add_read(nbytes, int(resp.headers.get("content-length") or len(resp.content or b"")), time.time() - started)
+        return resp
+    finally:
+        trace_logger.debug("run=%s op=%s %s %s%s %s %.3fs" % (RUN_ID, current_op(), method.upper(), host, path, status, time.time() - started))
+
+# -- =================================================================================
+# -- dry run cost estimate (--dry-run)
+#
+# With ctx.cfg.dry_run, the helpers read as usual (reads are needed to plan the work, and their
+# latency and bandwidth are measured) but don't write: catalog writes are counted by request()
+# and hatrac transfers by upload_file. The report estimates the wall time of the writes and
+# transfers from the measured reads, or from est_latency and est_bandwidth of the
+# performance profile of the context when there are too few reads to measure.
+#
+class DryRunResponse():
+    status_code = 200
+
+    def __init__(self, body=None):
+        self.body = body
+        self.headers = {}
+        self.content = json.dumps(body).encode("utf-8") if body is not None else b""
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+class CostEstimate():
+    def __init__(self, ctx=None):
+        self.ctx = ctx
+        self.lock = threading.Lock()
+        self.reads = {"requests": 0, "request_bytes": 0, "response_bytes": 0, "seconds": 0.0}
+        self.writes = {"requests": 0, "request_bytes": 0, "response_bytes": 0}
+        self.transfers = {"objects": 0, "download_bytes": 0, "upload_bytes": 0}
+
+    def add_read(self, request_bytes, response_bytes, seconds):
+        with self.lock:
+            self.reads["requests"] += 1
+            self.reads["request_bytes"] += request_bytes
+            self.reads["response_bytes"] += response_bytes
+            self.reads["seconds"] += seconds
+
+    def add_write(self, request_bytes, response_bytes):
+        with self.lock:
+            self.writes["requests"] += 1
+            self.writes["request_bytes"] += request_bytes
+            self.writes["response_bytes"] += response_bytes
+
+    def add_transfer(self, download_bytes, upload_bytes):
+        with self.lock:
+            self.transfers["objects"] += 1
+            self.transfers["download_bytes"] += download_bytes
+            self.transfers["upload_bytes"] += upload_bytes
+
+    def report(self):
+        config = get_context(self.ctx).cfg
+        latency = config.perf("est_latency")
+        bandwidth = config.perf("est_bandwidth")
+        measured = self.reads["requests"] >= 5
+        if measured:
+            latency = self.reads["seconds"] / self.reads["requests"]
+            if self.reads["response_bytes"] > 1024 * 1024:
+                bandwidth = self.reads["response_bytes"] / self.reads["seconds"]
+        write_seconds = self.writes["requests"] * latency + (self.writes["request_bytes"] + self.writes["response_bytes"]) / bandwidth
+        transfer_seconds = (self.transfers["download_bytes"] + self.transfers["upload_bytes"]) / bandwidth / config.perf("hatrac_workers")
+        return {
+            "reads": dict(self.reads), "writes": dict(self.writes), "transfers": dict(self.transfers),
+            "latency": latency, "bandwidth": bandwidth, "measured": measured,
+            "estimated_write_seconds": write_seconds,
+            "estimated_transfer_seconds": transfer_seconds,
+            "estimated_seconds": write_seconds + transfer_seconds,
+        }
+
+    def print_report(self):
+        report = self.report()
+        print("=========== dry run cost estimate: run %s ============" % (RUN_ID))
+        print("reads (sent):     %d requests, %d request bytes, %d response bytes, %.2fs" % (report["reads"]["requests"], report["reads"]["request_bytes"], report["reads"]["response_bytes"], report["reads"]["seconds"]))
+        print("writes (planned): %d requests, %d request bytes, ~%d response bytes" % (report["writes"]["requests"], report["writes"]["request_bytes"], report["writes"]["response_bytes"]))
+        print("hatrac (planned): %d objects, %.2f MiB download, %.2f MiB upload" % (report["transfers"]["objects"], report["transfers"]["download_bytes"]/(1024*1024), report["transfers"]["upload_bytes"]/(1024*1024)))
+        print("estimate: %.1fs (writes %.1fs, transfers %.1fs) at %.3fs/request and %.2f MiB/s (%s)" % (
+            report["estimated_seconds"], report["estimated_write_seconds"], report["estimated_transfer_seconds"],
+            report["latency"], report["bandwidth"]/(1024*1024), "measured" if report["measured"] else "profile defaults"))
+        return report
+
+# -- =================================================================================
+# -- run profiler (--profile)
+#
+# Profile the main thread with cProfile and report, at exit, the wall and cpu time of the
+# process, the time spent in network calls (summed over threads, from run_stats), the time of
+# each operation (see trace_operation), and the hottest functions.
+# With out_file, the cProfile stats are written to out_file (see python -m pstats) and the
+# summary to out_file.json.
+#
+class RunProfiler():
+    def __init__(self, out_file=None, top=30):
+        # -- only needed with --profile
+        import cProfile
+        self.out_file = out_file
+        self.top = top
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.started = time.time()
+        self.cpu_started = time.process_time()
+        atexit.register(self.stop)
+        self.profiler.enable()
+        return self
+
+    def summary(self):
+        return {
+            "run": RUN_ID,
+            "wall_seconds": time.time() - self.started,
+            "cpu_seconds": time.process_time() - self.cpu_started,
+            "network_calls": run_stats.calls,
+            "network_seconds": run_stats.call_seconds,
+            "admission_wait_seconds": run_stats.admission_seconds,
+            "retries": run_stats.retries,
+            "retry_sleep_seconds": run_stats.retry_seconds,
+            "operations": { name: {"count": n, "seconds": t} for name, (n, t) in sorted(run_stats.ops.items(), key=lambda e: -e[1][1]) },
+        }
+
+    def stop(self):
+        import io
+        import pstats
+        self.profiler.disable()
+        summary = self.summary()
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(self.top)
+        print("=========== profile: run %s ============" % (RUN_ID))
+        print("wall: %.2fs, cpu: %.2fs" % (summary["wall_seconds"], summary["cpu_seconds"]))
+        print("network: %.2fs in %d calls (summed over threads), admission wait: %.2fs, retries: %d (%.2fs sleep)" % (
+            summary["network_seconds"], summary["network_calls"], summary["admission_wait_seconds"], summary["retries"], summary["retry_sleep_seconds"]))
+        for name, stat in summary["operations"].items():
+            print("  %-40s %6d %10.2fs" % (name, stat["count"], stat["seconds"]))
+        print(out.getvalue())
+        if self.out_file:
+            self.profiler.dump_stats(self.out_file)
+            with open("%s.json" % (self.out_file), "w") as f:
+                json.dump(summary, f, indent=2)
+
+run_profiler = None
 
 # -- =================================================================================
 # -- add catalog_id as an optional argument with default for SMITE
@@ -88,13 +893,29 @@ class AtlasD2KCLI(BaseCLI):
         self.parser.add_argument('--catalog-id', metavar='<id>', help="Deriva catalog ID (default=2)", default=2, required=catalog_id_required)
         self.parser.add_argument('--pre-print', action="store_true", help="print annotations before clear", default=False)
         self.parser.add_argument('--post-print', action="store_true", help="print anntoations after update", default=False)
-        self.parser.add_argument('--dry-run', action="store_true", help="run the script without model.apply()", default=False)
+        self.parser.add_argument('--dry-run', action="store_true", help="run the script without model.apply() and without data writes or hatrac transfers, and print the estimated cost", default=False)
+        self.parser.add_argument('--perf-profile', metavar='<name>', help="performance profile (default=prod, staging, or dev based on --host)", default=None)
+        self.parser.add_argument('--profile', action="store_true", help="profile the run and print a summary (cpu, network, operations, hot functions) at exit", default=False)
+        self.parser.add_argument('--profile-out', metavar='<file>', help="with --profile, write the cProfile stats to file and the summary to file.json", default=None)
+        self.parser.add_argument('--trace-log', metavar='<file>', help="log the timing of operations and requests (with their run and op IDs) to file", default=None)
+        self.parser.add_argument('--perf-profiles', metavar='<file>', help="json file of performance profiles (default=%s)" % (DEFAULT_PERF_PROFILE_FILE), default=DEFAULT_PERF_PROFILE_FILE)
     
     def parse_cli(self):
-        global env
+        global run_profiler
         args = super().parse_cli()
-
-        cfg.apply_hostname(args.host)
+        if args.profile or args.profile_out:
+            run_profiler = RunProfiler(args.profile_out).start()
+        default_context.configure(args.host, args.catalog_id, credential_file=args.credential_file, profile_name=args.perf_profile,
+                                  profile_file=args.perf_profiles, dry_run=args.dry_run)
+        if args.dry_run:
+            atexit.register(default_context.cost_estimate.print_report)
+        cfg.get_profile()
+        if args.trace_log:
+            handler = logging.FileHandler(args.trace_log)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+            trace_logger.addHandler(handler)
+            trace_logger.setLevel(logging.DEBUG)
+            trace_logger.info("run=%s host=%s argv=%s" % (RUN_ID, args.host, " ".join(sys.argv)))
         
         return args
 
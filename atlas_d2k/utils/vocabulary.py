@@ -0,0 +1,308 @@
+#!/usr/bin/python
+
+import sys
+import re
+import json
+import hashlib
+import unicodedata
+from .data import get_entities, insert_if_not_exist, update_table_rows
+from .shared import get_context
+
+# -- =================================================================================
+# -- ontology term loader
+#
+# Terms of OBO or OWL (RDF/XML) ontology files (e.g. UBERON, CL, HsapDv) are streamed one at a
+# time, so the file is never loaded in memory. A term is a dict:
+#   {"id": "UBERON:0000955", "uri": "http://purl.obolibrary.org/obo/UBERON_0000955",
+#    "name": "brain", "description": ..., "synonyms": [...], "obsolete": False}
+# and is mapped to the ID, URI, Name, Description, and Synonyms (text[]) columns of the
+# vocabulary tables (see create_vocabulary_tdoc and create_vocab_tdoc).
+#
+OBO_PURL = "http://purl.obolibrary.org/obo/"
+
+NS = {
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "owl": "http://www.w3.org/2002/07/owl#",
+    "oboInOwl": "http://www.geneontology.org/formats/oboInOwl#",
+    "obo": "http://purl.obolibrary.org/obo/",
+}
+OWL_SYNONYM_TAGS = [ "{%s}%s" % (NS["oboInOwl"], s) for s in ["hasExactSynonym", "hasRelatedSynonym", "hasBroadSynonym", "hasNarrowSynonym"] ]
+
+# ontology term attribute -> vocabulary column
+DEFAULT_TERM_COLUMNS = {"id": "ID", "uri": "URI", "name": "Name", "description": "Description", "synonyms": "Synonyms"}
+
+# ----------------------------------------------------------
+def open_ontology_file(file_path):
+    if file_path.endswith(".gz"):
+        import gzip
+        return gzip.open(file_path, "rt", encoding="utf-8")
+    return open(file_path, encoding="utf-8")
+
+# ----------------------------------------------------------
+# UBERON:0000955 <-> http://purl.obolibrary.org/obo/UBERON_0000955
+def curie_to_uri(curie):
+    return OBO_PURL + curie.replace(":", "_", 1)
+
+def uri_to_curie(uri):
+    if not uri.startswith(OBO_PURL): return None
+    local_id = uri[len(OBO_PURL):]
+    return local_id.replace("_", ":", 1) if "_" in local_id else None
+
+# ----------------------------------------------------------
+# first quoted string of an obo tag value e.g. '"brain" EXACT []' -> 'brain'
+def obo_quoted_value(value):
+    m = re.match(r'^"((?:[^"\\]|\\.)*)"', value)
+    if not m: return None
+    return re.sub(r'\\(.)', r'\1', m[1])
+
+# ----------------------------------------------------------
+def new_term():
+    return {"id": None, "uri": None, "name": None, "description": None, "synonyms": [], "obsolete": False}
+
+# ----------------------------------------------------------
+# stream the [Term] stanzas of an obo file
+def iter_obo_terms(file_path):
+    term = None
+    with open_ontology_file(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                if term and term["id"]:
+                    yield term
+                term = new_term() if line == "[Term]" else None
+                continue
+            if term is None or not line or line.startswith("!"): continue
+            tag_name, sep, value = line.partition(":")
+            if not sep: continue
+            value = value.strip()
+            if tag_name == "id":
+                term["id"] = value
+                term["uri"] = curie_to_uri(value)
+            elif tag_name == "name":
+                term["name"] = value
+            elif tag_name == "def":
+                term["description"] = obo_quoted_value(value)
+            elif tag_name == "synonym":
+                synonym = obo_quoted_value(value)
+                if synonym: term["synonyms"].append(synonym)
+            elif tag_name == "is_obsolete":
+                term["obsolete"] = (value == "true")
+    if term and term["id"]:
+        yield term
+
+# ----------------------------------------------------------
+# stream the named owl:Class elements (direct children of rdf:RDF) of an owl file. Each element
+# is dropped from the tree once processed.
+def iter_owl_terms(file_path):
+    import xml.etree.ElementTree as ET
+    owl_class = "{%s}Class" % (NS["owl"])
+    about = "{%s}about" % (NS["rdf"])
+    label = "{%s}label" % (NS["rdfs"])
+    oboinowl_id = "{%s}id" % (NS["oboInOwl"])
+    definition = "{%s}IAO_0000115" % (NS["obo"])
+    deprecated = "{%s}deprecated" % (NS["owl"])
+    depth = 0
+    root = None
+    with open_ontology_file(file_path) as f:
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if root is None: root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1: continue
+            if elem.tag == owl_class and elem.get(about):
+                term = new_term()
+                term["uri"] = elem.get(about)
+                for child in elem:
+                    text = (child.text or "").strip()
+                    if not text: continue
+                    if child.tag == label and term["name"] is None:
+                        term["name"] = text
+                    elif child.tag == oboinowl_id:
+                        term["id"] = text
+                    elif child.tag == definition and term["description"] is None:
+                        term["description"] = text
+                    elif child.tag in OWL_SYNONYM_TAGS:
+                        term["synonyms"].append(text)
+                    elif child.tag == deprecated:
+                        term["obsolete"] = (text == "true")
+                if not term["id"]:
+                    term["id"] = uri_to_curie(term["uri"])
+                if term["id"]:
+                    yield term
+            root.clear()
+
+# ----------------------------------------------------------
+# stream the terms of an obo or owl file. Obsolete terms are skipped unless include_obsolete.
+# id_prefixes limits the terms to those of the given ontologies e.g. ["UBERON"], since
+# ontologies often include terms imported from other ontologies.
+def iter_ontology_terms(file_path, id_prefixes=None, include_obsolete=False):
+    if re.search(r"\.obo(\.gz)?$", file_path):
+        terms = iter_obo_terms(file_path)
+    else:
+        terms = iter_owl_terms(file_path)
+    for term in terms:
+        if term["obsolete"] and not include_obsolete: continue
+        if id_prefixes and term["id"].split(":")[0] not in id_prefixes: continue
+        yield term
+
+# ----------------------------------------------------------
+# map a term to a vocabulary row. columns maps term attributes to column names (e.g. drop
+# "synonyms" for tables without Synonyms). Synonyms are de-duplicated and sorted.
+def term_to_row(term, columns=DEFAULT_TERM_COLUMNS):
+    row = {}
+    for attr, cname in columns.items():
+        value = term.get(attr)
+        if attr == "synonyms":
+            value = sorted(set([ s for s in value if s != term["name"] ])) or None
+        row[cname] = value
+    return row
+
+# ----------------------------------------------------------
+def row_fingerprint(row, cnames):
+    return hashlib.sha1(json.dumps([ row.get(c) for c in cnames ], sort_keys=True).encode("utf-8")).hexdigest()
+
+# ----------------------------------------------------------
+# Load the terms of an ontology file into a vocabulary table, keyed on ID:
+#  - the existing rows are read once and only their fingerprints are kept
+#  - terms are read from the file in batches of batch_rows; new terms are inserted and terms
+#    whose content changed are updated. Unchanged terms are skipped.
+# Terms without a name are skipped since Name is not nullable.
+# Return {"inserted": n, "updated": n, "unchanged": n, "skipped": n}
+def load_ontology_terms(catalog, schema_name, table_name, file_path, id_prefixes=None, columns=DEFAULT_TERM_COLUMNS, include_obsolete=False, batch_rows=None, ctx=None):
+    ctx = get_context(ctx, catalog)
+    batch_rows = ctx.cfg.perf("insert_batch_rows", batch_rows)
+    key = columns["id"]
+    cnames = [ c for c in columns.values() if c != key ]
+    existing = { row[key]: row_fingerprint(row, cnames) for row in get_entities(catalog, schema_name, table_name, keys=[key], attr_list=cnames, sort=[key], ctx=ctx) }
+    print("load_ontology_terms: %s:%s has %d rows" % (schema_name, table_name, len(existing)))
+
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    def flush(to_insert, to_update):
+        if to_insert:
+            counts["inserted"] += len(insert_if_not_exist(catalog, schema_name, table_name, to_insert, batch_size=batch_rows, ctx=ctx))
+        if to_update:
+            counts["updated"] += len(update_table_rows(catalog, schema_name, table_name, key=key, column_names=cnames, payload=to_update, batch_size=batch_rows, ctx=ctx))
+
+    to_insert, to_update = [], []
+    seen = set()
+    for term in iter_ontology_terms(file_path, id_prefixes, include_obsolete):
+        row = term_to_row(term, columns)
+        if not row.get(columns["name"]) or row[key] in seen:
+            counts["skipped"] += 1
+            continue
+        seen.add(row[key])
+        fingerprint = existing.get(row[key])
+        if fingerprint is None:
+            to_insert.append(row)
+        elif fingerprint != row_fingerprint(row, cnames):
+            to_update.append(row)
+        else:
+            counts["unchanged"] += 1
+        if len(to_insert) + len(to_update) >= batch_rows:
+            flush(to_insert, to_update)
+            to_insert, to_update = [], []
+    flush(to_insert, to_update)
+    print("load_ontology_terms: %s:%s %s" % (schema_name, table_name, json.dumps(counts)))
+    return counts
+
+# -- =================================================================================
+# -- term normalization
+#
+# TermNormalizer maps submitted values (names, IDs, synonyms, variant spellings) to a column of
+# a vocabulary table (Name by default), so the values match the fkey before the payload is
+# inserted. Values are folded (case, accents, punctuation, and whitespace) before lookup.
+# Names and IDs take precedence over synonyms. A folded value shared by different terms is
+# ambiguous and is not normalized. With fuzzy_cutoff (0-1), values without an exact match fall
+# back to the closest folded value (difflib).
+# The index is built by the constructor and only read afterwards, so a normalizer can be shared
+# by threads.
+#
+def fold_term(value):
+    value = unicodedata.normalize("NFKD", str(value))
+    value = "".join([ c for c in value if not unicodedata.combining(c) ]).casefold()
+    return " ".join(re.sub(r"[\W_]+", " ", value).split())
+
+class TermNormalizer():
+    def __init__(self, rows, target="Name", primary_columns=["Name", "ID"], synonym_column="Synonyms", fuzzy_cutoff=None):
+        self.target = target
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.index = {}         # folded value -> target value, or None if ambiguous
+        synonyms = {}
+        for row in rows:
+            for cname in primary_columns:
+                if row.get(cname): self.add(self.index, row[cname], row[target])
+            for synonym in (row.get(synonym_column) or []) if synonym_column else []:
+                self.add(synonyms, synonym, row[target])
+        for folded, value in synonyms.items():
+            self.index.setdefault(folded, value)
+        self.folded_values = [ k for k, v in self.index.items() if v is not None ]
+
+    @classmethod
+    def from_table(cls, catalog, schema_name, table_name, target="Name", primary_columns=["Name", "ID"], synonym_column="Synonyms", fuzzy_cutoff=None, ctx=None):
+        attr_list = [ c for c in primary_columns + [synonym_column] if c and c != target ]
+        rows = get_entities(catalog, schema_name, table_name, keys=[target], attr_list=attr_list, sort=[target], ctx=ctx)
+        return cls(rows, target, primary_columns, synonym_column, fuzzy_cutoff)
+
+    @staticmethod
+    def add(index, value, target_value):
+        folded = fold_term(value)
+        if folded in index and index[folded] != target_value:
+            index[folded] = None
+        else:
+            index[folded] = target_value
+
+    def normalize(self, value):
+        return self.normalize_values([value]).get(value)
+
+    # return {value: target value} for the values that can be normalized. Each distinct value is
+    # looked up once.
+    def normalize_values(self, values):
+        result = {}
+        for value in set([ v for v in values if v is not None ]):
+            folded = fold_term(value)
+            target_value = self.index.get(folded)
+            if target_value is None and self.fuzzy_cutoff and folded not in self.index:
+                import difflib
+                matches = difflib.get_close_matches(folded, self.folded_values, n=1, cutoff=self.fuzzy_cutoff)
+                if matches:
+                    target_value = self.index[matches[0]]
+                    print("TermNormalizer: fuzzy match %r -> %r" % (value, target_value))
+            if target_value is not None:
+                result[value] = target_value
+        return result
+
+    # normalize a column of the payload in place. Return the values that could not be
+    # normalized: [(row index, column, value)]
+    def normalize_column(self, payload, cname):
+        mapping = self.normalize_values([ row.get(cname) for row in payload ])
+        unresolved = []
+        for index, row in enumerate(payload):
+            value = row.get(cname)
+            if value is None: continue
+            if value in mapping:
+                row[cname] = mapping[value]
+            else:
+                unresolved.append((index, cname, value))
+        return unresolved
+
+# ----------------------------------------------------------
+# normalizers are cached in the context of the catalog
+def get_term_normalizer(catalog, schema_name, table_name, target="Name", fuzzy_cutoff=None, ctx=None):
+    ctx = get_context(ctx, catalog)
+    normalizer_key = (catalog._server, catalog.catalog_id, schema_name, table_name, target, fuzzy_cutoff)
+    return ctx.get_cached("term_normalizers", normalizer_key, lambda: TermNormalizer.from_table(catalog, schema_name, table_name, target=target, fuzzy_cutoff=fuzzy_cutoff, ctx=ctx))
+
+# ----------------------------------------------------------
+# normalize the vocabulary columns of a payload in place before e.g. insert_if_exist_update.
+# columns maps a payload column to the vocabulary (schema_name, table_name) e.g.
+#   normalize_payload(catalog, payload, {"Species": ("Vocabulary", "Species")})
+# Return the values that could not be normalized: [(row index, column, value)]
+def normalize_payload(catalog, payload, columns, target="Name", fuzzy_cutoff=None, ctx=None):
+    unresolved = []
+    for cname, (schema_name, table_name) in columns.items():
+        normalizer = get_term_normalizer(catalog, schema_name, table_name, target=target, fuzzy_cutoff=fuzzy_cutoff, ctx=ctx)
+        unresolved.extend(normalizer.normalize_column(payload, cname))
+    return unresolved